@@ -0,0 +1,85 @@
+#    OctoPrint Upgrade To Python 3: Move an existing install over from py2 to 3
+#    Copyright (C) 2020-2021 Charlie Powell
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Minimal PEP 517 build backend, copied into the benchmark's fake plugin archives.
+# It has no build requirements so plugins can be built without a network connection,
+# and sleeps for a while to stand in for a real build.
+import base64
+import hashlib
+import json
+import os
+import time
+import zipfile
+
+
+def write_wheel(directory, name, version, modules=None, entry_points=None, requires=None, extra_files=None):
+    """Write a pure Python wheel into directory
+
+    extra_files maps any other paths to put in the wheel to their contents.
+
+    Returns:
+        str: file name of the wheel
+    """
+    dist = name.replace('-', '_')
+    dist_info = '{}-{}.dist-info'.format(dist, version)
+    filename = '{}-{}-py3-none-any.whl'.format(dist, version)
+
+    files = {}
+    for module in modules or []:
+        files['{}/__init__.py'.format(module)] = b''
+    for path, data in (extra_files or {}).items():
+        files[path] = data.encode('utf-8') if isinstance(data, str) else data
+
+    metadata = 'Metadata-Version: 2.1\nName: {}\nVersion: {}\n'.format(name, version)
+    for requirement in requires or []:
+        metadata += 'Requires-Dist: {}\n'.format(requirement)
+    files[dist_info + '/METADATA'] = metadata.encode('utf-8')
+    files[dist_info + '/WHEEL'] = b'Wheel-Version: 1.0\nGenerator: benchmark\nRoot-Is-Purelib: true\nTag: py3-none-any\n'
+
+    if entry_points:
+        text = ''
+        for group, entries in entry_points.items():
+            text += '[{}]\n'.format(group)
+            text += ''.join('{} = {}\n'.format(key, value) for key, value in entries.items())
+        files[dist_info + '/entry_points.txt'] = text.encode('utf-8')
+
+    record = []
+    for path, data in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b'=').decode('ascii')
+        record.append('{},sha256={},{}'.format(path, digest, len(data)))
+    record.append('{}/RECORD,,'.format(dist_info))
+    files[dist_info + '/RECORD'] = ('\n'.join(record) + '\n').encode('utf-8')
+
+    with zipfile.ZipFile(os.path.join(directory, filename), 'w') as wheel:
+        for path, data in files.items():
+            wheel.writestr(path, data)
+    return filename
+
+
+def _plugin_config():
+    with open('plugin.json', 'r') as config_file:
+        return json.load(config_file)
+
+
+def get_requires_for_build_wheel(config_settings=None):
+    return []
+
+
+def build_wheel(wheel_directory, config_settings=None, metadata_directory=None):
+    config = _plugin_config()
+    time.sleep(config.get('build_time', 0))
+    return write_wheel(wheel_directory, config['name'], config['version'], config['modules'],
+                       config.get('entry_points'), config.get('requires'))
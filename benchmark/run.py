@@ -0,0 +1,492 @@
+#    OctoPrint Upgrade To Python 3: Move an existing install over from py2 to 3
+#    Copyright (C) 2020-2021 Charlie Powell
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+End to end benchmark of upgrade.py, that runs on any Linux machine without a Pi or internet connection
+
+Sets up:
+* A fake Python 2 venv, with OctoPrint 1.4.2 & a number of plugins "installed"
+* Stub sudo, apt-get, dpkg-query and service commands
+* A local HTTP server with a synthetic plugins.json, plugin archives & a package index with OctoPrint on it
+
+Most plugins build with a self-contained PEP 517 backend. Some use a setup.py like OctoPrint's plugin template,
+which imports octoprint_setuptools from OctoPrint, so they only build once OctoPrint is in the venv.
+
+Then runs upgrade.py through its normal flow in --custom --force mode, and reports the time taken by each phase.
+
+Usage: python3 benchmark/run.py [--plugins 20] [--runs 3] [-- extra upgrade.py arguments]
+"""
+import argparse
+import http.server
+import io
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+UPGRADE_SCRIPT = os.path.join(os.path.dirname(BENCHMARK_DIR), 'upgrade.py')
+
+sys.path.insert(0, BENCHMARK_DIR)
+from fake_build_backend import write_wheel  # noqa: E402
+
+OCTOPRINT_VERSION = '1.9.0'
+
+FAKE_PYTHON2 = """#!{python}
+# Stands in for the Python 2 interpreter of an OctoPrint 1.4.2 venv
+import json, os, sys, time, zipfile
+
+args = sys.argv[1:]
+if args == ['--version']:
+    sys.stderr.write('Python 2.7.18\\n')
+elif args[:2] == ['-m', 'octoprint'] and '--version' in args:
+    print('OctoPrint, version 1.4.2')
+elif args[:2] == ['-m', 'octoprint'] and 'backup:backup' in args:
+    basedir = args[args.index('--basedir') + 1]
+    backup_dir = os.path.join(basedir, 'data', 'backup')
+    os.makedirs(backup_dir, exist_ok=True)
+    name = 'octoprint-backup-{{}}'.format(time.strftime('%Y%m%d-%H%M%S'))
+    print('Creating backup at {{}}.zip'.format(name))
+    with zipfile.ZipFile(os.path.join(backup_dir, name + '.zip'), 'w') as backup:
+        backup.writestr('plugin_list.json', json.dumps({plugin_list}))
+else:
+    sys.exit(1)
+"""
+
+STUB = """#!/bin/sh
+sleep {latency}
+{body}
+"""
+
+STUBS = {
+    # Everything passed to sudo is run as the current user, without a password
+    'sudo': 'while [ "${1#-}" != "$1" ]; do shift; done\nexec "$@"',
+    'apt-get': 'echo "apt-get $*"',
+    'service': 'echo "service $*"',
+    'dpkg-query': 'printf "python3-dev\\tinstall ok installed\\t3.7.3-1\\npython3-venv\\tinstall ok installed\\t3.7.3-1\\n"',
+}
+
+# Stands in for the octoprint_setuptools module that comes with OctoPrint
+OCTOPRINT_SETUPTOOLS = """
+def create_plugin_setup_parameters(identifier='todo', package=None, name='OctoPrint-Plugin', version='0.1', requires=None, **kwargs):
+    package = package or 'octoprint_{}'.format(identifier)
+    return {
+        'name': name,
+        'version': version,
+        'packages': [package],
+        'install_requires': requires or [],
+        'entry_points': {'octoprint.plugin': ['{} = {}'.format(identifier, package)]},
+    }
+"""
+
+# setup.py of OctoPrint's plugin template, so pip builds it with setup.py bdist_wheel in the venv
+LEGACY_SETUP_PY = """
+import json
+
+try:
+    import octoprint_setuptools
+except ImportError:
+    print("Could not load OctoPrint's setuptools, are you sure you are running this under "
+          "the same python installation that OctoPrint is installed under?")
+    import sys
+    sys.exit(-1)
+
+with open('plugin.json', 'r') as config_file:
+    config = json.load(config_file)
+
+setup_parameters = octoprint_setuptools.create_plugin_setup_parameters(
+    identifier=config['key'], package=config['modules'][0], name=config['name'], version=config['version'],
+    requires=config['requires'])
+
+from setuptools import setup
+setup(**setup_parameters)
+"""
+
+# The wheel package's bdist_wheel command, which the benchmark's "wheel" provides by calling the fake build backend
+BDIST_WHEEL = """
+from setuptools import Command
+
+from wheel.fake_build_backend import build_wheel
+
+
+class bdist_wheel(Command):
+    description = "build a wheel with the benchmark's fake build backend"
+    user_options = [('dist-dir=', 'd', "directory to put the wheel in")]
+
+    def initialize_options(self):
+        self.dist_dir = None
+
+    def finalize_options(self):
+        self.dist_dir = self.dist_dir or 'dist'
+
+    def run(self):
+        build_wheel(self.dist_dir)
+"""
+
+PIP_ENV_VARS = ('PIP_INDEX_URL', 'PIP_EXTRA_INDEX_URL', 'PIP_FIND_LINKS', 'PIP_CONFIG_FILE', 'PIP_NO_INDEX')
+
+
+def plugin_id(number):
+    return 'benchplugin{}'.format(number)
+
+
+def make_plugin_archive(number, build_time, broken=False, legacy=False):
+    """Zip up a plugin source tree like GitHub's archive downloads, using the fake build backend
+
+    Broken plugins build, but depend on a package that doesn't exist so they can't be installed. Legacy
+    plugins have a template setup.py instead of a pyproject.toml, so need OctoPrint installed to build.
+    """
+    key = plugin_id(number)
+    top = '{}-master/'.format(key)
+    config = {
+        'key': key,
+        'name': 'OctoPrint-BenchPlugin{}'.format(number),
+        'version': '1.0.0',
+        'modules': ['octoprint_{}'.format(key)],
+        'entry_points': {'octoprint.plugin': {key: 'octoprint_{}'.format(key)}},
+        'build_time': build_time,
+        'requires': ['benchmark-missing-dependency>=1.0'] if broken else [],
+    }
+    with open(os.path.join(BENCHMARK_DIR, 'fake_build_backend.py'), 'rb') as backend:
+        backend_source = backend.read()
+
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        if legacy:
+            archive.writestr(top + 'setup.py', LEGACY_SETUP_PY)
+            archive.writestr(top + 'octoprint_{}/__init__.py'.format(key), '')
+        else:
+            archive.writestr(top + 'pyproject.toml', '[build-system]\nrequires = []\n'
+                                                     'build-backend = "fake_build_backend"\nbackend-path = ["."]\n')
+            archive.writestr(top + 'fake_build_backend.py', backend_source)
+        archive.writestr(top + 'plugin.json', json.dumps(config))
+    return data.getvalue()
+
+
+def make_plugin_repo(base_url, plugins, repo_size, python2_only=()):
+    """A plugins.json with the installed plugins, padded out with others to a realistic size"""
+    repo = []
+    for number in range(max(plugins, repo_size)):
+        repo.append({
+            'id': plugin_id(number),
+            'title': 'Benchmark Plugin {}'.format(number),
+            'archive': '{}/archive/{}.zip'.format(base_url, plugin_id(number)),
+            'description': 'A plugin that only exists for benchmarking. ' * 5,
+            'compatibility': {'octoprint': ['>=1.4.0'], 'os': [], 'python': '>=2.7,<3' if number in python2_only else '>=2.7,<4'},
+            'homepage': 'https://example.com/{}'.format(plugin_id(number)),
+            'license': 'AGPLv3',
+        })
+    return json.dumps(repo).encode('utf-8')
+
+
+def make_package_index(work_dir):
+    """Wheels for the local package index: a dependency-free OctoPrint, wheel, and pip & setuptools copied from ensurepip"""
+    wheel_dir = os.path.join(work_dir, 'index')
+    os.makedirs(wheel_dir)
+    write_wheel(wheel_dir, 'OctoPrint', OCTOPRINT_VERSION, ['octoprint'],
+                {'console_scripts': {'octoprint': 'octoprint:main'}},
+                extra_files={'octoprint_setuptools/__init__.py': OCTOPRINT_SETUPTOOLS})
+    with open(os.path.join(BENCHMARK_DIR, 'fake_build_backend.py'), 'rb') as backend:
+        backend_source = backend.read()
+    write_wheel(wheel_dir, 'wheel', '0.0.1', ['wheel'], {'distutils.commands': {'bdist_wheel': 'wheel.bdist_wheel:bdist_wheel'}},
+                extra_files={'wheel/bdist_wheel.py': BDIST_WHEEL, 'wheel/fake_build_backend.py': backend_source})
+
+    import ensurepip
+    bundled = os.path.join(os.path.dirname(ensurepip.__file__), '_bundled')
+    if os.path.isdir(bundled):
+        for filename in os.listdir(bundled):
+            if filename.startswith(('pip-', 'setuptools-')):
+                shutil.copy(os.path.join(bundled, filename), wheel_dir)
+
+    index = {}
+    for filename in os.listdir(wheel_dir):
+        project = filename.split('-')[0].lower().replace('_', '-')
+        index.setdefault(project, []).append(filename)
+    return wheel_dir, index
+
+
+class BenchmarkServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, plugins, build_time, repo_size, broken, python2_only, legacy, wheel_dir, index):
+        super().__init__(('127.0.0.1', 0), BenchmarkHandler)
+        self.latency = latency
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.plugins_json = make_plugin_repo(self.base_url, plugins, repo_size, python2_only)
+        self.archives = {plugin_id(number): make_plugin_archive(number, build_time, number in broken, number in legacy)
+                         for number in range(plugins)}
+        self.wheel_dir = wheel_dir
+        self.index = index
+        # Status OctoPrint's API answers with once it has been "started", 403 as there's no API key
+        self.api_status = 403
+
+
+class BenchmarkHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        path = self.path.split('?')[0]
+        parts = [part for part in path.split('/') if part]
+
+        if path == '/api/version':
+            return self.send_error(self.server.api_status)
+
+        if path == '/plugins.json':
+            return self.send(self.server.plugins_json, 'application/json')
+
+        if len(parts) == 2 and parts[0] == 'archive' and parts[1][:-4] in self.server.archives:
+            return self.send(self.server.archives[parts[1][:-4]], 'application/zip')
+
+        if parts == ['simple']:
+            links = ''.join('<a href="/simple/{0}/">{0}</a>\n'.format(project) for project in self.server.index)
+            return self.send('<html><body>{}</body></html>'.format(links).encode('utf-8'), 'text/html')
+
+        if len(parts) == 2 and parts[0] == 'simple' and parts[1] in self.server.index:
+            links = ''.join('<a href="/files/{0}">{0}</a>\n'.format(name) for name in self.server.index[parts[1]])
+            return self.send('<html><body>{}</body></html>'.format(links).encode('utf-8'), 'text/html')
+
+        if len(parts) == 2 and parts[0] == 'files' and os.path.isfile(os.path.join(self.server.wheel_dir, parts[1])):
+            with open(os.path.join(self.server.wheel_dir, parts[1]), 'rb') as wheel:
+                return self.send(wheel.read(), 'application/octet-stream')
+
+        self.send_error(404)
+
+    do_HEAD = do_GET
+
+
+def write_executable(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def make_fake_install(work_dir, plugins, command_latency, port):
+    """Create the fake Python 2 venv, OctoPrint basedir & stub commands
+
+    OctoPrint's server is configured to be the benchmark server, so it is always "running".
+
+    Returns:
+        tuple: venv path, basedir path, stub bin directory
+    """
+    venv = os.path.join(work_dir, 'oprint')
+    basedir = os.path.join(work_dir, '.octoprint')
+    stub_dir = os.path.join(work_dir, 'stubs')
+    for directory in (os.path.join(venv, 'bin'), basedir, stub_dir):
+        os.makedirs(directory)
+
+    with open(os.path.join(basedir, 'config.yaml'), 'w') as config:
+        config.write('server:\n  host: 127.0.0.1\n  port: {}\n'.format(port))
+
+    plugin_list = [{'key': plugin_id(number), 'name': 'Benchmark Plugin {}'.format(number)} for number in range(plugins)]
+    write_executable(os.path.join(venv, 'bin', 'python'),
+                     FAKE_PYTHON2.format(python=sys.executable, plugin_list=repr(plugin_list)))
+
+    site_packages = os.path.join(venv, 'lib', 'python2.7', 'site-packages')
+    octoprint_info = os.path.join(site_packages, 'OctoPrint-1.4.2-py2.7.egg-info')
+    os.makedirs(octoprint_info)
+    with open(os.path.join(octoprint_info, 'PKG-INFO'), 'w') as pkg_info:
+        pkg_info.write('Metadata-Version: 1.1\nName: OctoPrint\nVersion: 1.4.2\n')
+    for number in range(plugins):
+        egg_info = os.path.join(site_packages, 'OctoPrint_BenchPlugin{}-1.0.0-py2.7.egg-info'.format(number))
+        os.makedirs(egg_info)
+        with open(os.path.join(egg_info, 'PKG-INFO'), 'w') as pkg_info:
+            pkg_info.write('Metadata-Version: 1.0\nName: OctoPrint-BenchPlugin{}\nVersion: 1.0.0\n'.format(number))
+        with open(os.path.join(egg_info, 'entry_points.txt'), 'w') as entry_points:
+            entry_points.write('[octoprint.plugin]\n{} = octoprint_{}\n'.format(plugin_id(number), plugin_id(number)))
+
+    for name, body in STUBS.items():
+        write_executable(os.path.join(stub_dir, name), STUB.format(latency=command_latency, body=body))
+
+    return venv, basedir, stub_dir
+
+
+def read_phases(event_log):
+    """Add up the duration of each phase in the event log
+
+    Returns:
+        dict: (name, depth) -> seconds, in the order the phases first started
+    """
+    phases = {}
+    with open(event_log, 'r') as events:
+        for line in events:
+            event = json.loads(line)
+            if event['event'] == 'phase_start':
+                phases.setdefault((event['phase'], event['depth']), 0.0)
+            elif event['event'] == 'phase_end':
+                key = (event['phase'], event['depth'])
+                phases[key] = phases.get(key, 0.0) + event['duration']
+    return phases
+
+
+def run_once(options, run_number, upgrade_args):
+    work_dir = tempfile.mkdtemp(prefix='octoprint-upgrade-benchmark-')
+    server = None
+    try:
+        wheel_dir, index = make_package_index(work_dir)
+        server = BenchmarkServer(options.http_latency, options.plugins, options.build_time, options.repo_size,
+                                 range(options.plugins - options.broken_plugins, options.plugins),
+                                 range(options.python2_plugins),
+                                 range(options.python2_plugins, options.python2_plugins + options.legacy_plugins), wheel_dir, index)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        if options.octoprint_down:
+            server.api_status = 503
+        venv, basedir, stub_dir = make_fake_install(work_dir, options.plugins, options.command_latency, server.server_address[1])
+        event_log = os.path.join(work_dir, 'events.jsonl')
+
+        env = {key: value for key, value in os.environ.items() if key not in PIP_ENV_VARS}
+        env.update({
+            'PATH': stub_dir + os.pathsep + env.get('PATH', ''),
+            'XDG_CACHE_HOME': os.path.join(work_dir, 'cache'),
+            'PIP_INDEX_URL': server.base_url + '/simple/',
+            'PIP_TRUSTED_HOST': '127.0.0.1',
+            'PIP_DISABLE_PIP_VERSION_CHECK': '1',
+            'PIP_NO_CACHE_DIR': '1',
+        })
+        command = [sys.executable, UPGRADE_SCRIPT, '--custom', '--force', '--iknowwhatimdoing',
+                   '--plugin-repo', server.base_url + '/plugins.json', '--event-log', event_log] + upgrade_args
+        # Answers to the custom install prompts: venv, config dir, stop & start commands
+        answers = '\n'.join([venv, basedir, 'sudo service octoprint stop', 'sudo service octoprint start']) + '\n'
+
+        start = time.time()
+        result = subprocess.run(command, input=answers.encode('utf-8'), env=env, cwd=work_dir,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        wall_time = time.time() - start
+
+        log_path = os.path.join(options.output_dir, 'run-{}.log'.format(run_number)) if options.output_dir else None
+        if log_path:
+            with open(log_path, 'wb') as log:
+                log.write(result.stdout)
+
+        installed = len([name for name in os.listdir(os.path.join(venv, 'lib', 'python{}.{}'.format(*sys.version_info[:2]), 'site-packages'))
+                         if name.startswith('OctoPrint_BenchPlugin') and name.endswith('.dist-info')]) \
+            if result.returncode == 0 else 0
+
+        if result.returncode != 0:
+            print("Run {} failed with exit code {}".format(run_number, result.returncode))
+            print(result.stdout.decode('utf-8', errors='replace')[-3000:])
+
+        return {
+            'exit_code': result.returncode,
+            'wall_time': wall_time,
+            'plugins_installed': installed,
+            'phases': read_phases(event_log) if os.path.isfile(event_log) else {},
+        }
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        if options.keep:
+            print("Kept benchmark files at {}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def report(results):
+    phase_keys = []
+    for result in results:
+        phase_keys.extend(key for key in result['phases'] if key not in phase_keys)
+
+    header = "{:<40}".format("Phase") + "".join("{:>10}".format("Run {}".format(number)) for number in range(1, len(results) + 1))
+    header += "{:>10}".format("Mean")
+    print("\n" + header)
+    print("-" * len(header))
+
+    def row(label, values):
+        values = [value for value in values if value is not None]
+        mean = sum(values) / len(values) if values else 0
+        cells = "".join("{:>9.1f}s".format(value) for value in values)
+        print("{:<40}{}{:>9.1f}s".format(label, cells, mean))
+
+    for name, depth in phase_keys:
+        row("  " * depth + name, [result['phases'].get((name, depth), 0.0) for result in results])
+    row("Wall time", [result['wall_time'] for result in results])
+
+    print("\nPlugins installed: {}".format(", ".join(str(result['plugins_installed']) for result in results)))
+    print("Exit codes: {}".format(", ".join(str(result['exit_code']) for result in results)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark upgrade.py end to end against local stand-ins for pip, apt & the plugin repo",
+                                     epilog="Arguments after -- are passed on to upgrade.py, eg. -- --blue-green --jobs 2")
+    parser.add_argument('--plugins', type=int, default=10, help="Number of plugins installed in the fake venv (default 10)")
+    parser.add_argument('--repo-size', type=int, default=300, help="Number of plugins on the fake plugin repo (default 300)")
+    parser.add_argument('--build-time', type=float, default=1.0, help="Seconds each plugin takes to build (default 1.0)")
+    parser.add_argument('--broken-plugins', type=int, default=0,
+                        help="Number of the plugins that depend on a package that doesn't exist, so fail to install (default 0)")
+    parser.add_argument('--python2-plugins', type=int, default=0,
+                        help="Number of the plugins that the plugin repo lists as Python 2 only (default 0)")
+    parser.add_argument('--legacy-plugins', type=int, default=1,
+                        help="Number of the plugins with a template setup.py that imports octoprint_setuptools, "
+                             "rather than a pyproject.toml (default 1)")
+    parser.add_argument('--octoprint-down', action='store_true',
+                        help="Make OctoPrint's API never answer, to try out the upgrade failing to start it")
+    parser.add_argument('--http-latency', type=float, default=0.05, help="Seconds added to every HTTP request (default 0.05)")
+    parser.add_argument('--command-latency', type=float, default=0.2,
+                        help="Seconds added to every stubbed apt-get, dpkg-query, sudo & service command (default 0.2)")
+    parser.add_argument('--runs', type=int, default=1, help="Number of times to run the benchmark (default 1)")
+    parser.add_argument('--output-dir', help="Save the output of upgrade.py for each run in this directory")
+    parser.add_argument('--json', metavar='FILE', help="Also write the results as JSON to FILE")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary files of each run")
+
+    argv = sys.argv[1:]
+    upgrade_args = []
+    if '--' in argv:
+        upgrade_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    options = parser.parse_args(argv)
+
+    if options.output_dir:
+        os.makedirs(options.output_dir, exist_ok=True)
+
+    results = []
+    for run_number in range(1, options.runs + 1):
+        print("Run {}/{}: {} plugin(s), upgrade.py {}".format(run_number, options.runs, options.plugins, " ".join(upgrade_args)))
+        results.append(run_once(options, run_number, upgrade_args))
+
+    report(results)
+
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump({
+                'options': vars(options),
+                'upgrade_args': upgrade_args,
+                'runs': [dict(result, phases=[{'phase': name, 'depth': depth, 'duration': duration}
+                                              for (name, depth), duration in result['phases'].items()])
+                         for result in results],
+            }, json_file, indent=2)
+
+    return 0 if all(result['exit_code'] == 0 for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
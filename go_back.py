@@ -6,7 +6,9 @@ if sys.version_info.major != 3:
     sys.exit(0)
 
 import os
+import selectors
 import subprocess
+import time
 
 BASE = '\033['
 
@@ -23,6 +25,42 @@ class TextStyles:
     NORMAL = BASE + '22m'
 
 
+# Stop any command that hangs, rather than leaving the install half reverted forever
+COMMAND_TIMEOUT = 600
+
+
+def run_command(command, timeout=COMMAND_TIMEOUT):
+    """Run a command, reading stdout & stderr until it exits or times out. Returns the exit code"""
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    deadline = time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    for stream in (process.stdout, process.stderr):
+        selector.register(stream, selectors.EVENT_READ)
+
+    while selector.get_map():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print("{}ERROR: `{}` took longer than {} seconds{}".format(TextColors.RED, " ".join(command), timeout, TextColors.RESET))
+            process.kill()
+            break
+        for key, mask in selector.select(remaining):
+            data = os.read(key.fd, 64 * 1024)
+            if not data:
+                selector.unregister(key.fileobj)
+            elif key.fileobj is process.stderr:
+                # Errors are still shown, as they were before
+                sys.stderr.write(data.decode('utf-8', errors='replace'))
+
+    selector.close()
+    process.stdout.close()
+    process.stderr.close()
+    return process.wait()
+
+
 print("OctoPrint upgrade to Python 3: go_back.py (v1.1)")
 print("This script will move your old installation back (Just in case!)")
 print("{}Only use it if you have used the upgrade script and it failed{}".format(TextColors.YELLOW, TextColors.RESET))
@@ -56,6 +94,47 @@ else:
     START_COMMAND = input("Start command: ")
 
 
+def switch_back(path_to_venv):
+    """Point a versioned venv symlink at the environment before the current one. Returns the version switched to"""
+    versions_dir = '{}.versions'.format(path_to_venv)
+    switch_link = '{}.switching'.format(path_to_venv)
+    versions = sorted(name for name in os.listdir(versions_dir) if os.path.isfile(os.path.join(versions_dir, name, 'bin', 'python')))
+    current = os.path.basename(os.path.realpath(path_to_venv))
+    index = versions.index(current) if current in versions else len(versions)
+    if index == 0:
+        return None
+
+    target = versions[index - 1]
+    if os.path.lexists(switch_link):
+        os.remove(switch_link)
+    os.symlink(os.path.relpath(os.path.join(versions_dir, target), os.path.dirname(os.path.abspath(path_to_venv))), switch_link)
+    os.replace(switch_link, path_to_venv)
+    return target
+
+
+PATH_TO_VENV = PATH_TO_VENV.rstrip('/')
+if os.path.islink(PATH_TO_VENV) and os.path.isdir('{}.versions'.format(PATH_TO_VENV)):
+    # Versioned install (upgrade.py --versioned), going back is just switching the symlink
+    if STOP_COMMAND and run_command(STOP_COMMAND.split()) != 0:
+        print("{}ERROR: failed to stop OctoPrint{}".format(TextColors.RED, TextColors.RESET))
+        sys.exit(0)
+    try:
+        version = switch_back(PATH_TO_VENV)
+    except OSError as e:
+        version = None
+        print("{}ERROR: failed to switch environment: {}{}".format(TextColors.RED, e, TextColors.RESET))
+    else:
+        if not version:
+            print("{}ERROR: there is no older environment to go back to{}".format(TextColors.RED, TextColors.RESET))
+    if START_COMMAND:
+        run_command(START_COMMAND.split())
+    if not version:
+        sys.exit(0)
+
+    print("Successfully switched to {}".format(version))
+    print("The newer environment is still in {}.versions, run this script again to go back further".format(PATH_TO_VENV))
+    sys.exit(0)
+
 COMMANDS = [
     STOP_COMMAND.split(),
     ['mv', PATH_TO_VENV, '{}FAIL.bak'.format(PATH_TO_VENV)],
@@ -63,16 +142,7 @@ COMMANDS = [
     START_COMMAND.split()
 ]
 for command in COMMANDS:
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE
-    )
-    while True:
-        output = process.stdout.readline().decode('utf-8')
-        poll = process.poll()
-        if output == '' and poll is not None:
-            break
-    if process.poll() != 0:
+    if run_command(command) != 0:
         print("{}ERROR: failed to restore backup{}".format(TextColors.RED, TextColors.RESET))
         print("Please try manually")
         print("Exiting")
@@ -26,13 +26,47 @@ if sys.version_info.major != 3 or (sys.version_info.major == 3 and sys.version_i
 import os
 import json
 import subprocess
-import zipfile
 import re
 import argparse
+import shutil
+import tempfile
+import codecs
+import selectors
+import signal
+import time
+import glob
+import threading
+import contextlib
+import functools
+import collections
+import itertools
+import importlib.util
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 # CONSTANTS
 SCRIPT_VERSION = '2.2.2'
 PATH_TO_OCTOPI_VERSION = '/etc/octopi_version'
+PATH_TO_DPKG_STATUS = '/var/lib/dpkg/status'
+PATH_TO_APT_LISTS = '/var/lib/apt/lists'
+# Touched by apt after every successful update on Debian & derivatives that have update-notifier-common
+PATH_TO_APT_UPDATE_STAMP = '/var/lib/apt/periodic/update-success-stamp'
+PLUGIN_REPO_URL = DEFAULT_PLUGIN_REPO_URL = 'https://plugins.octoprint.org/plugins.json'
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'octoprint-upgrade-py3')
+PLUGIN_REPO_CACHE = os.path.join(CACHE_DIR, 'plugin_repo.json')
+# Only these fields of each plugin on the repo are used, the rest is thrown away while parsing
+PLUGIN_REPO_FIELDS = ('id', 'archive', 'title', 'compatibility')
+# Plugins installed as dependencies of OctoPrint, which it treats as bundled (its plugin_considered_bundled)
+BUNDLED_PLUGINS = ('firmware_check', 'file_check', 'pi_support')
+RESOLVED_CONSTRAINTS = os.path.join(CACHE_DIR, 'constraints.txt')
+STATE_FILE = os.path.join(CACHE_DIR, 'state.json')
+APT_UPDATE_STAMP = os.path.join(CACHE_DIR, 'apt-update-stamp')
+COMMAND_LOG = os.path.join(CACHE_DIR, 'logs', 'commands.log')
+# Seconds between redraws of the progress line
+PROGRESS_INTERVAL = 0.5
+# Lines of each command's output kept in memory, everything is in the command log
+OUTPUT_TAIL_LINES = 200
+# Seconds a command that timed out is given to exit after SIGTERM, before it & everything it started is killed
+KILL_GRACE = 10
 
 
 class OctoPi:
@@ -57,7 +91,8 @@ class TextStyles:
 
 # ------------------
 # Command line argument setup
-# Sets necessary flags that the rest of the script can access
+# Sets necessary flags that the rest of the script can access. Nothing is parsed on import, so the
+# script can be imported & driven from Python - see configure() & main()
 # ------------------
 parser = argparse.ArgumentParser(
     description="Upgrade your Python 2 OctoPrint install to Python 3")
@@ -76,14 +111,199 @@ parser.add_argument(
     action="store_true",
     help="Prints absolutely everything to the terminal, useful for debugging failures"
 )
+parser.add_argument(
+    '-j', '--jobs',
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of plugins to build in parallel (defaults to the number of CPU cores)"
+)
+parser.add_argument(
+    '--manifest',
+    metavar="FILE",
+    help="Upgrade all the OctoPrint instances listed in a JSON manifest at the same time, without prompting"
+)
+parser.add_argument(
+    '--backup',
+    action="store_true",
+    help="Also create a full OctoPrint backup in the background, which is kept afterwards. "
+         "Installed plugins are read straight from the virtual environment either way"
+)
+parser.add_argument(
+    '--snapshot',
+    action="store_true",
+    help="Like --backup, but snapshot the config directory with reflinks or hardlinks instead of compressing it into a zip"
+)
+parser.add_argument(
+    '--snapshot-zip',
+    action="store_true",
+    help="With --snapshot, turn the snapshot into a zip OctoPrint can restore once the upgrade has finished"
+)
+parser.add_argument(
+    '--blue-green',
+    action="store_true",
+    help="Build the new Python 3 environment next to the old one while OctoPrint keeps running, "
+         "only stopping it to swap the environments over"
+)
+parser.add_argument(
+    '--versioned',
+    action="store_true",
+    help="Keep each environment in its own directory next to the venv, with the venv path a symlink to the current one. "
+         "OctoPrint keeps running until the symlink is switched"
+)
+parser.add_argument(
+    '--keep',
+    type=int,
+    default=2,
+    metavar="N",
+    help="With --versioned, the number of previous environments to keep. Default 2"
+)
+parser.add_argument(
+    '--resume',
+    action="store_true",
+    help="Continue an upgrade that was interrupted, skipping the steps it already completed"
+)
+parser.add_argument(
+    '--command-timeout',
+    type=int,
+    default=3600,
+    metavar="SECONDS",
+    help="Stop any single command (apt, pip etc.) that takes longer than this. 0 to disable. Default 3600"
+)
+parser.add_argument(
+    '--package-list-ttl',
+    type=int,
+    default=3600,
+    metavar="SECONDS",
+    help="Don't update the apt package list if it was updated less than this long ago. 0 to always update. Default 3600"
+)
+parser.add_argument(
+    '--resolve-first',
+    action="store_true",
+    help="Resolve OctoPrint & all plugins against Python 3 before stopping OctoPrint, reporting problems up front. "
+         "The resolved versions are then used for the install"
+)
+parser.add_argument(
+    '--single-pass',
+    action="store_true",
+    help="Install OctoPrint & all plugins with one pip run, so dependencies are only resolved once"
+)
+parser.add_argument(
+    '--no-precompile',
+    action="store_true",
+    help="Don't precompile the new environment's Python files in parallel, let pip compile them one at a time as it installs"
+)
+parser.add_argument(
+    '--defer-precompile',
+    action="store_true",
+    help="Precompile the new environment's Python files after OctoPrint has been started, rather than before"
+)
+parser.add_argument(
+    '--no-prefetch',
+    action="store_true",
+    help="Don't download plugin archives in the background while OctoPrint installs, let pip download each one when building it"
+)
+parser.add_argument(
+    '--wheelhouse',
+    metavar="PATH",
+    help="Install OctoPrint & plugins from a wheelhouse directory or tarball made with --build-wheelhouse. "
+         "Only packages missing from it are downloaded"
+)
+parser.add_argument(
+    '--build-wheelhouse',
+    metavar="PATH",
+    help="Build a wheelhouse of OctoPrint & the plugins in the --from-backup backup, then exit. "
+         "Use a path ending in .tar.gz to create a tarball"
+)
+parser.add_argument(
+    '--from-backup',
+    metavar="BACKUP_ZIP",
+    help="OctoPrint backup to read the list of plugins from, for --build-wheelhouse"
+)
+parser.add_argument(
+    '--plugin-repo',
+    metavar="URL",
+    help="Use a different plugin repository (plugins.json), for example a local mirror"
+)
+parser.add_argument(
+    '--ready-timeout',
+    type=int,
+    default=300,
+    metavar="SECONDS",
+    help="After starting OctoPrint, wait this long for it to answer on the host & port in config.yaml. 0 to not wait. Default 300"
+)
+parser.add_argument(
+    '--rollback-on-failure',
+    action="store_true",
+    help="Go back to the old environment if OctoPrint doesn't answer within --ready-timeout seconds"
+)
+parser.add_argument(
+    '--command-log',
+    metavar="FILE",
+    default=COMMAND_LOG,
+    help="Write the full output of every command run to FILE. Default {}".format(COMMAND_LOG)
+)
+parser.add_argument(
+    '--event-log',
+    metavar="FILE",
+    help="Write a JSON line for the start & end of every phase and every command run to FILE, for finding slow steps"
+)
 parser.add_argument(
     '--iknowwhatimdoing',
     action="store_true"
 )
-args = parser.parse_args()
+# The defaults, until configure() is called with the real options
+args = parser.parse_args([])
 
 FORCE_CUSTOM = args.custom
 FORCE_CONFIRMS = args.force
+# Constraints file passed to every pip install, set once dependencies have been resolved with --resolve-first
+PIP_CONSTRAINTS = None
+# Background downloads of plugin archives, started once the plugins to install are known
+PREFETCH = None
+# Limits plugin builds to --jobs at a time across everything running, such as several instances from a manifest
+BUILD_SLOTS = threading.BoundedSemaphore(max(1, args.jobs))
+
+
+def make_options(argv=(), **options):
+    """Create the options for configure(), as they would be parsed from the command line
+
+    Args:
+        argv (list): command line arguments, for example ['--force', '--jobs', '2']
+        **options: options to set by name, overriding argv, for example blue_green=True
+
+    Returns:
+        argparse.Namespace: the options
+    """
+    result = parser.parse_args(list(argv))
+    for name, value in options.items():
+        if not hasattr(result, name):
+            raise TypeError("Unknown option: {}".format(name))
+        setattr(result, name, value)
+    return result
+
+
+def configure(options):
+    """Use these options for everything the script does from now on
+
+    Args:
+        options (argparse.Namespace): options from make_options()
+    """
+    global args, FORCE_CUSTOM, FORCE_CONFIRMS, PLUGIN_REPO_URL, PIP_CONSTRAINTS, PREFETCH, BUILD_SLOTS
+    args = options
+    FORCE_CUSTOM = options.custom
+    FORCE_CONFIRMS = options.force
+    PLUGIN_REPO_URL = options.plugin_repo or DEFAULT_PLUGIN_REPO_URL
+
+    # Nothing from an earlier run in the same process should carry over
+    PIP_CONSTRAINTS = None
+    PREFETCH = None
+    BUILD_SLOTS = threading.BoundedSemaphore(max(1, options.jobs))
+    fetch_plugin_repo.cache_clear()
+    DpkgStatus.invalidate()
+    EVENTS.reset()
+    PROGRESS.close_log()
+    PROGRESS.enabled = sys.stdout.isatty()
+    JOURNAL.state = None
 
 
 # ------------------
@@ -96,31 +316,628 @@ def print_c(msg, color=TextColors.YELLOW, style=None, end='\n'):
         print(color, style, msg, TextColors.RESET, TextStyles.NORMAL, end=end, sep="")
 
 
-def run_sys_command(command, custom_parser=False, sudo=False):
-    output = []
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-    )
-    last_state = None
-    while True:
-        output_line = process.stdout.readline().decode('utf-8', errors="replace")
-        # errors='replace' means replace any unicode decoding errors as a `?`
-        # Should solve #7
-        poll = process.poll()
-        if output_line == '' and poll is not None:
-            break
-        if output_line:
-            if not args.debug:
-                if callable(custom_parser):
-                    last_state = custom_parser(output_line, last_state)
-                if sudo and 'sudo' in output_line:
-                    print(output_line, end="")
+class EventLog:
+    """Times each phase of the upgrade & every command run, optionally writing them out as JSON lines
+
+    Phases can be used as a context manager or a decorator: `with EVENTS.phase('name'):` or `@EVENTS.phase('name')`
+    """
+    def __init__(self):
+        self.log_file = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        # (name, depth, duration) of each finished phase, in the order they started
+        self.phases = []
+
+    def open(self, path):
+        self.log_file = open(path, 'a')
+        self.emit('run_start', version=SCRIPT_VERSION, argv=sys.argv[1:])
+
+    def emit(self, event, **fields):
+        if not self.log_file:
+            return
+        fields.update({'event': event, 'time': time.time(), 'thread': threading.current_thread().name})
+        with self.lock:
+            self.log_file.write(json.dumps(fields) + '\n')
+            self.log_file.flush()
+
+    def current_phase(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        depth = len(self.local.stack)
+        with self.lock:
+            index = len(self.phases)
+            self.phases.append((name, depth, None))
+        self.local.stack.append(name)
+
+        self.emit('phase_start', phase=name, depth=depth, **fields)
+        start = time.time()
+        status = 'ok'
+        try:
+            yield
+        except SystemExit:
+            status = 'bailed'
+            raise
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            duration = time.time() - start
+            self.local.stack.pop()
+            with self.lock:
+                self.phases[index] = (name, depth, duration)
+            self.emit('phase_end', phase=name, depth=depth, start=start, end=start + duration, duration=duration, status=status,
+                      **fields)
+
+    def wrap(self, func):
+        """Wrap func to be run in another thread, with its phases nested under the current phase"""
+        stack = list(getattr(self.local, 'stack', []))
+
+        def wrapper(*func_args, **func_kwargs):
+            self.local.stack = list(stack)
+            return func(*func_args, **func_kwargs)
+        return wrapper
+
+    def command(self, command):
+        self.emit('command', id=command.id, command=command.command, phase=self.current_phase(), start=command.started,
+                  end=command.started + command.duration, duration=command.duration, exit_code=command.poll,
+                  timed_out=command.timed_out, stdout_bytes=command.stdout_bytes, stderr_bytes=command.stderr_bytes)
+
+    def reset(self):
+        """Close the log & forget the phases so far, ready for another run"""
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+        self.started = time.time()
+        self.phases = []
+
+    def summary(self):
+        """Print where the time went, phase by phase"""
+        total = time.time() - self.started
+        self.emit('run_end', duration=total)
+
+        # Phases that ran more than once (eg. building each plugin) are added together
+        totals = {}
+        for name, depth, duration in self.phases:
+            if duration is None:
+                continue
+            key = (name, depth)
+            count, seconds = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, seconds + duration)
+
+        print("\nTime taken")
+        for (name, depth), (count, seconds) in totals.items():
+            label = "{}{}{}".format("  " * depth, name, " (x{})".format(count) if count > 1 else "")
+            print("{:<40} {:>8.1f}s {:>5.1f}%".format(label, seconds, 100 * seconds / total if total else 0))
+        print("{:<40} {:>8.1f}s".format("Total", total))
+
+
+EVENTS = EventLog()
+
+
+class StateJournal:
+    """Records the progress of an upgrade on disk, so an interrupted run can be picked up again with --resume
+
+    The state is written after every change, to a temporary file that replaces the old one, so the journal is
+    never left half written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.state = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return None
+        return state if isinstance(state, dict) and state.get('version') == SCRIPT_VERSION else None
+
+    def start(self, venv_path, config_dir, commands, plugin_keys, backup_path):
+        self.state = {
+            'version': SCRIPT_VERSION,
+            'mode': self.mode(),
+            'venv': venv_path,
+            'config_dir': config_dir,
+            'commands': commands,
+            'plugin_keys': list(plugin_keys),
+            'backup': backup_path,
+            'completed': [],
+            'installed_plugins': [],
+        }
+        self.save()
+
+    def resume(self):
+        """Load the journal of an interrupted upgrade, making sure it can still be continued"""
+        state = self.load()
+        if not state:
+            bail("There is no interrupted upgrade to resume")
+        if state['mode'] != self.mode():
+            bail("The interrupted upgrade used different options ({}), please resume with the same ones".format(
+                ", ".join(state['mode']) or "none"))
+
+        venv_path = state['venv']
+        if not any(os.path.exists(path) for path in (venv_path, '{}.bak'.format(venv_path))):
+            bail("Cannot resume: neither {} nor {}.bak exist anymore".format(venv_path, venv_path))
+        if state['backup'] and not os.path.isfile(state['backup']):
+            print_c("The backup {} has gone, continuing without it".format(state['backup']), TextColors.YELLOW)
+            state['backup'] = None
+
+        self.state = state
+        print_c("Resuming the upgrade of {}".format(venv_path), TextColors.GREEN)
+        if state['completed']:
+            print("Already done: {}".format(", ".join(state['completed'])))
+        return state
+
+    @staticmethod
+    def mode():
+        return [option for option in ('blue_green', 'versioned', 'single_pass') if getattr(args, option)]
+
+    def save(self):
+        if self.state is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with self.lock:
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w') as state_file:
+                    json.dump(self.state, state_file, indent=2)
+                os.replace(temp_path, self.path)
+        except OSError:
+            print_c("Warning: Could not save progress to {}, this run can't be resumed".format(self.path), TextColors.YELLOW)
+
+    def done(self, step):
+        return self.state is not None and step in self.state['completed']
+
+    def complete(self, step):
+        if self.state is not None and step not in self.state['completed']:
+            self.state['completed'].append(step)
+            self.save()
+
+    def update(self, **fields):
+        if self.state is not None:
+            self.state.update(fields)
+            self.save()
+
+    def plugin_installed(self, key):
+        if self.state is not None and key not in self.state['installed_plugins']:
+            self.state['installed_plugins'].append(key)
+            self.save()
+
+    def step(self, name, func, *func_args, valid=None):
+        """Run func, unless a previous run already completed this step & valid() (if given) says it still holds"""
+        if self.done(name) and (valid is None or valid()):
+            print("Skipping {}, it was completed by the interrupted run".format(name))
+            return None
+        result = func(*func_args)
+        self.complete(name)
+        return result
+
+    def clear(self):
+        self.state = None
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+
+
+JOURNAL = StateJournal(STATE_FILE)
+
+
+class CommandOutput:
+    """The output of a command, holding only its last lines & the lines matching patterns watched for in memory
+
+    A big pip install or dpkg-query can print a lot of output, which on a 512MB Pi is memory that pip &
+    the compiler could be using. All of it is written to the command log as it arrives, so nothing is
+    lost. Iterating gives the lines that were kept, in order.
+    """
+    def __init__(self, watch=(), size=OUTPUT_TAIL_LINES):
+        self.watch = [re.compile(pattern) for pattern in watch]
+        self.tail = collections.deque(maxlen=size)
+        self.matched = []
+        self.count = 0
+
+    def append(self, line):
+        self.count += 1
+        if any(pattern.search(line) for pattern in self.watch):
+            self.matched.append((self.count, line))
+        self.tail.append((self.count, line))
+
+    def __iter__(self):
+        # A watched line may also still be in the tail, so merge them by line number
+        return iter([line for number, line in sorted(dict(self.matched + list(self.tail)).items())])
+
+
+class Command:
+    """A command for run_sys_commands, holding its output & exit code once it has finished"""
+    # Commands run at the same time write to the command log together, so each line is tagged with an id
+    _ids = itertools.count(1)
+
+    def __init__(self, command, custom_parser=False, sudo=False, timeout=None, show_stderr=True, watch=()):
+        self.id = next(Command._ids)
+        self.command = command
+        self.custom_parser = custom_parser
+        self.sudo = sudo
+        self.timeout = timeout if timeout is not None else args.command_timeout
+        self.show_stderr = show_stderr
+        self.output = CommandOutput(watch)
+        self.poll = None
+        self.timed_out = False
+        self.process = None
+        self.own_session = False
+        self.deadline = None
+        self.streams = []
+        self.last_state = None
+        self.started = None
+        self.duration = None
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+
+    def handle_line(self, line, stderr=False):
+        PROGRESS.log("[{}] {}{}".format(self.id, line, "" if line.endswith("\n") else "\n"))
+        # Parsers may need every line, not just the ones kept in output. pip & apt write their errors to stderr
+        if callable(self.custom_parser):
+            self.last_state = self.custom_parser(line, self.last_state)
+        if args.debug:
+            print(line)
+        elif stderr:
+            # stderr used to go straight to the terminal, so keep showing it, unless a parser picks out the errors
+            if self.show_stderr and not callable(self.custom_parser):
+                PROGRESS.message(line.rstrip('\n'))
+        elif self.sudo and 'sudo' in line:
+            print(line, end="")
+        self.output.append(line)
+
+    def send_signal(self, signum):
+        """Signal the command, and everything it started if it has its own session"""
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            if self.own_session:
+                os.killpg(self.process.pid, signum)
+            else:
+                self.process.send_signal(signum)
+
+
+class Progress:
+    """Shows the progress of pip & apt on a single status line, redrawn at most every PROGRESS_INTERVAL seconds
+
+    Printing every line of output can slow the upgrade down on serial consoles & slow SSH connections, so instead
+    every line of every command goes to a log file, and only errors & a summary are printed.
+    """
+    def __init__(self):
+        self.log_file = None
+        self.lock = threading.Lock()
+        self.enabled = sys.stdout.isatty()
+        self.last_render = 0
+        self.shown = False
+
+    def open_log(self, path):
+        self.close_log()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.log_file = open(path, 'a')
+        except OSError as e:
+            print_c("Warning: Could not open command log {}: {}".format(path, e), TextColors.YELLOW)
+
+    def close_log(self):
+        with self.lock:
+            if self.log_file:
+                self.log_file.close()
+                self.log_file = None
+
+    def log(self, text):
+        if self.log_file:
+            with self.lock:
+                self.log_file.write(text)
+
+    def flush_log(self):
+        if self.log_file:
+            with self.lock:
+                self.log_file.flush()
+
+    def update(self, status):
+        if not self.enabled or args.debug:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_render < PROGRESS_INTERVAL:
+                return
+            self.last_render = now
+            width = shutil.get_terminal_size().columns - 1
+            sys.stdout.write('\r' + status[:width] + '\033[K')
+            sys.stdout.flush()
+            self.shown = True
+
+    def clear(self):
+        with self.lock:
+            if self.shown:
+                sys.stdout.write('\r\033[K')
+                sys.stdout.flush()
+                self.shown = False
+                # Show the next update straight away
+                self.last_render = 0
+
+    def message(self, msg, color=None):
+        """Print a line, moving the status line out of the way first"""
+        self.clear()
+        if color:
+            print_c(msg, color)
+        else:
+            print(msg)
+
+
+PROGRESS = Progress()
+
+
+def format_bytes(count):
+    for unit in ('B', 'kB', 'MB'):
+        if count < 1024:
+            return "{:.0f} {}".format(count, unit) if unit == 'B' else "{:.1f} {}".format(count, unit)
+        count /= 1024
+    return "{:.1f} GB".format(count)
+
+
+def parse_size(number, unit):
+    return float(number.replace(',', '')) * {'bytes': 1, 'B': 1, 'kB': 1024, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}.get(unit, 1)
+
+
+class PipProgress:
+    """What a pip command is doing, worked out from its output one line at a time"""
+    COLLECTING = re.compile(r"^\s*Collecting (\S+)")
+    DOWNLOADING = re.compile(r"^\s*Downloading (\S+) \(([\d.,]+) (bytes|B|kB|MB|GB)\)")
+    BUILDING = re.compile(r"^\s*(?:Building wheel for|Running setup\.py bdist_wheel for|Running setup\.py install for) (\S+)")
+    INSTALLING = re.compile(r"^\s*Installing collected packages: (.*)")
+    INSTALLED = re.compile(r"^\s*Successfully installed (.*)")
+
+    def __init__(self):
+        self.stage = "Starting pip"
+        self.current = ""
+        self.collected = 0
+        self.downloaded = 0
+        self.download_bytes = 0
+        self.built = 0
+        self.installing = 0
+        self.installed = 0
+
+    def feed(self, line):
+        """Update from a line of output
+
+        Returns:
+            str: the line, if it is an error that should be shown
+        """
+        match = self.COLLECTING.match(line)
+        if match:
+            self.stage, self.current = "Collecting", match.group(1)
+            self.collected += 1
+            return None
+        match = self.DOWNLOADING.match(line)
+        if match:
+            self.stage, self.current = "Downloading", match.group(1).rsplit('/', 1)[-1]
+            self.downloaded += 1
+            self.download_bytes += parse_size(match.group(2), match.group(3))
+            return None
+        match = self.BUILDING.match(line)
+        if match:
+            self.stage, self.current = "Building", match.group(1)
+            self.built += 1
+            return None
+        match = self.INSTALLING.match(line)
+        if match:
+            self.stage, self.current = "Installing", ""
+            self.installing = len(match.group(1).split(','))
+            return None
+        match = self.INSTALLED.match(line)
+        if match:
+            self.installed = len(match.group(1).split())
+            return None
+        if line.startswith('ERROR') or line.lstrip().lower().startswith('error:'):
+            return line.rstrip()
+        return None
+
+    def status(self):
+        if self.stage == "Installing":
+            return "pip: installing {} package(s)".format(self.installing)
+        return "pip: {} {} | {} collected, {} downloaded ({}), {} built".format(
+            self.stage, self.current, self.collected, self.downloaded, format_bytes(self.download_bytes), self.built)
+
+    def summary(self):
+        if not self.installed and not self.collected:
+            return None
+        return "pip: {} package(s) installed, {} downloaded ({}), {} built".format(
+            self.installed, self.downloaded, format_bytes(self.download_bytes), self.built)
+
+
+class AptProgress:
+    """What an apt-get command is doing, worked out from its output one line at a time"""
+    FETCHING = re.compile(r"^Get:\d+ .*\[([\d.,]+) (B|kB|MB|GB)\]")
+    CHECKED = re.compile(r"^(?:Hit|Ign):\d+ ")
+    UNPACKING = re.compile(r"^Unpacking (\S+)")
+    SETTING_UP = re.compile(r"^Setting up (\S+)")
+
+    def __init__(self):
+        self.stage = "Starting apt"
+        self.current = ""
+        self.fetched = 0
+        self.fetch_bytes = 0
+        self.checked = 0
+        self.unpacked = 0
+        self.set_up = 0
+
+    def feed(self, line):
+        match = self.FETCHING.match(line)
+        if match:
+            self.stage = "Downloading"
+            self.fetched += 1
+            self.fetch_bytes += parse_size(match.group(1), match.group(2))
+            return None
+        if self.CHECKED.match(line):
+            self.stage = "Checking sources"
+            self.checked += 1
+            return None
+        match = self.UNPACKING.match(line)
+        if match:
+            self.stage, self.current = "Unpacking", match.group(1)
+            self.unpacked += 1
+            return None
+        match = self.SETTING_UP.match(line)
+        if match:
+            self.stage, self.current = "Setting up", match.group(1)
+            self.set_up += 1
+            return None
+        if line.startswith('E:'):
+            return line.rstrip()
+        return None
+
+    def status(self):
+        return "apt: {} {} | {} fetched ({}), {} unpacked, {} set up".format(
+            self.stage, self.current, self.fetched + self.checked, format_bytes(self.fetch_bytes), self.unpacked, self.set_up)
+
+    def summary(self):
+        return None
+
+
+def pip_output_parser(line, last_state):
+    """custom_parser for pip commands, showing their progress on the status line"""
+    return progress_parser(line, last_state or PipProgress())
+
+
+def apt_output_parser(line, last_state):
+    """custom_parser for apt-get commands, showing their progress on the status line"""
+    return progress_parser(line, last_state or AptProgress())
+
+
+def progress_parser(line, state):
+    error = state.feed(line)
+    if error:
+        PROGRESS.message(error, TextColors.RED)
+    PROGRESS.update(state.status())
+    return state
+
+
+def run_sys_commands(commands):
+    """Run several commands at the same time, reading stdout & stderr of all of them as data arrives
+
+    Output is decoded in chunks, and handed to each command's custom_parser line by line, in order.
+    Commands that take longer than their timeout are stopped, along with everything they started, so
+    apt-get or dpkg can't be left running & holding dpkg's lock.
+
+    Args:
+        commands (list): Command instances to run
+    """
+    selector = selectors.DefaultSelector()
+    for command in commands:
+        PROGRESS.log("[{}] $ {}\n".format(command.id, " ".join(command.command)))
+        command.started = time.time()
+        # A session of its own puts everything the command starts in one process group, to stop together. sudo
+        # can't ask for a password without the terminal though, so it keeps this one if it might have to
+        command.own_session = not (command.command[0] == 'sudo' and sudo_needs_terminal())
+        command.process = subprocess.Popen(
+            command.command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=command.own_session,
+        )
+        if command.timeout:
+            command.deadline = time.monotonic() + command.timeout
+        for stream, stderr in ((command.process.stdout, False), (command.process.stderr, True)):
+            # errors='replace' means replace any unicode decoding errors as a `?`
+            # Should solve #7
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            selector.register(stream, selectors.EVENT_READ, {'command': command, 'stderr': stderr, 'decoder': decoder, 'partial': ''})
+            command.streams.append(stream)
+
+    def close_stream(stream):
+        command = selector.unregister(stream).data['command']
+        command.streams.remove(stream)
+        stream.close()
+        if not command.streams:
+            command.duration = time.time() - command.started
+
+    while selector.get_map():
+        deadlines = [command.deadline for command in commands if command.deadline and command.streams]
+        timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+
+        for key, mask in selector.select(timeout):
+            state = key.data
+            data = os.read(key.fd, 64 * 1024)
+            if state['stderr']:
+                state['command'].stderr_bytes += len(data)
             else:
-                print(output_line)
-            output.append(output_line)
+                state['command'].stdout_bytes += len(data)
+            if data:
+                lines = (state['partial'] + state['decoder'].decode(data)).split('\n')
+                state['partial'] = lines.pop()
+                for line in lines:
+                    state['command'].handle_line(line + '\n', state['stderr'])
+            else:
+                # End of output, anything left over is a last line without a newline
+                rest = state['partial'] + state['decoder'].decode(b'', final=True)
+                if rest:
+                    state['command'].handle_line(rest, state['stderr'])
+                close_stream(key.fileobj)
+
+        now = time.monotonic()
+        for command in commands:
+            if command.deadline and command.streams and now >= command.deadline:
+                # Don't wait for the pipes to close, children of the command (eg. sudo -> apt-get) could hold them open.
+                # SIGTERM first, as sudo passes it on to the command it runs as root, which can't be killed from here
+                command.timed_out = True
+                command.send_signal(signal.SIGTERM)
+                for stream in list(command.streams):
+                    close_stream(stream)
+
+    for command in commands:
+        if command.timed_out:
+            with contextlib.suppress(subprocess.TimeoutExpired):
+                command.process.wait(timeout=KILL_GRACE)
+            # Anything the command started that is still running goes too
+            command.send_signal(signal.SIGKILL)
+        command.poll = command.process.wait()
+        EVENTS.command(command)
+        PROGRESS.log("[{}] [exit code {}]\n".format(command.id, command.poll))
+        if command.last_state is not None and hasattr(command.last_state, 'summary'):
+            summary = command.last_state.summary()
+            PROGRESS.clear()
+            if summary:
+                print(summary)
+        if command.timed_out:
+            print_c("ERROR: `{}` took longer than {} seconds and was stopped".format(" ".join(command.command), command.timeout),
+                    TextColors.RED)
+
+    selector.close()
+    PROGRESS.flush_log()
+
+
+@functools.lru_cache(maxsize=None)
+def sudo_needs_terminal():
+    """Whether sudo might ask for a password, which it can only read from the terminal
+
+    Returns:
+        bool: False if sudo is set up to not need a password
+    """
+    try:
+        # -k ignores a password entered recently, as commands in their own session can't use it
+        return subprocess.run(['sudo', '-n', '-k', 'true'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0
+    except OSError:
+        return True
+
+
+def run_sys_command(command, custom_parser=False, sudo=False, timeout=None, show_stderr=True, watch=()):
+    """Run a command, waiting for it to finish
+
+    Args:
+        watch (list): regular expressions for lines of output that must be kept, beyond the last OUTPUT_TAIL_LINES
 
-    return output, poll
+    Returns:
+        CommandOutput: the output that was kept
+        int: exit code
+    """
+    command = Command(command, custom_parser, sudo, timeout, show_stderr, watch)
+    run_sys_commands([command])
+    return command.output, command.poll
 
 
 def get_python_version(venv_path):
@@ -130,34 +947,29 @@ def get_python_version(venv_path):
     Runs system command `python --version` and returns output
 
     Returns:
-        list: List of output lines
+        CommandOutput: output lines, iterate over it to get them
         int: Exit Code from the process
     """
-    output = []
-    process = subprocess.Popen(
-        ['{}/bin/python'.format(venv_path), '--version'],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT
-    )
-    while True:
-        output_line_stderr = process.stdout.readline().decode('utf-8', errors='replace')
-        poll = process.poll()
-        if output_line_stderr == '' and process.poll() is not None:
-            break
-        if output_line_stderr:
-            output.append(output_line_stderr)
-
-    return output, poll
+    return run_sys_command(['{}/bin/python'.format(venv_path), '--version'], show_stderr=False)
 
 
 def bail(msg):
     print_c(msg, TextColors.RED)
+    if PREFETCH:
+        PREFETCH.stop()
     sys.exit(1)
 
 
-def cleanup(path_to_zipfile):
+def cleanup(backup_path):
+    if not backup_path:
+        # Plugins were read from the venv, there is no temporary backup to remove
+        return
     print("\nCleaning up...")
-    os.remove(path_to_zipfile)
+    if os.path.isdir(backup_path):
+        # Snapshot rather than a zip
+        shutil.rmtree(backup_path)
+    else:
+        os.remove(backup_path)
 
 
 def confirm_to_go(msg="Press [enter] to continue or ctrl-c to quit"):
@@ -172,25 +984,56 @@ def confirm_to_go(msg="Press [enter] to continue or ctrl-c to quit"):
         return False
 
 
-def run_apt_install(package, backup_path=None):
-    print("Installing {}...".format(package))
-    output, poll = run_sys_command(["sudo", "apt-get", "install", package, "-y"], sudo=True)
+def pip_install(venv_path, requirements, wheelhouse=None, custom_parser=False, show_stderr=True):
+    """Run `pip install` in the venv, preferring packages from the wheelhouse if one is in use
+
+    The wheelhouse is tried first without touching the network, and if something is missing from it
+    the install is retried with the package index available as well.
+    """
+    pip = ['{}/bin/python'.format(venv_path), '-m', 'pip', 'install']
+    if PIP_CONSTRAINTS:
+        pip += ['--constraint', PIP_CONSTRAINTS]
+    if not args.no_precompile:
+        # Everything is compiled at once by precompile_venv, using all the CPU cores
+        pip += ['--no-compile']
+    if not wheelhouse:
+        return run_sys_command(pip + requirements, custom_parser=custom_parser, show_stderr=show_stderr)
+
+    output, poll = run_sys_command(pip + ['--no-index', '--find-links', wheelhouse.wheel_dir] + requirements, custom_parser=custom_parser,
+                                   show_stderr=show_stderr)
+    if poll == 0:
+        return output, poll
+
+    print_c("Not everything needed is in the wheelhouse, falling back to downloading the rest", TextColors.YELLOW)
+    return run_sys_command(pip + ['--find-links', wheelhouse.wheel_dir] + requirements, custom_parser=custom_parser,
+                           show_stderr=show_stderr)
+
+
+@EVENTS.phase('run_apt_install')
+def run_apt_install(packages, backup_path=None):
+    """Install all the packages with a single apt-get run, so dpkg's lock, triggers & cache are only dealt with once"""
+    print("Installing {}...".format(", ".join(packages)))
+    output, poll = run_sys_command(["sudo", "apt-get", "install", "-y"] + list(packages), custom_parser=apt_output_parser, sudo=True,
+                                   watch=['newest version'])
+    DpkgStatus.invalidate()
     if poll != 0:
-        print_c("ERROR: failed to install {}".format(package), TextColors.RED)
+        print_c("ERROR: failed to install {}".format(", ".join(packages)), TextColors.RED)
         print_c("Please try manually")
         if backup_path:
             cleanup(backup_path)
         bail("Fatal error: Exiting")
     else:
-        for line in output:
-            if 'newest version' in line:
-                print_c(line, TextColors.GREEN)
-                return
-        print_c("Successfully installed {}".format(package), TextColors.GREEN)
+        newest = [line.strip() for line in output if 'newest version' in line]
+        for line in newest:
+            print_c(line, TextColors.GREEN)
+        if len(newest) < len(packages):
+            print_c("Successfully installed {}".format(", ".join(packages)), TextColors.GREEN)
 
+
+@EVENTS.phase('update_package_list')
 def update_package_list(backup_path=None):
     print("Updating package list...")
-    output, poll = run_sys_command(["sudo", "apt-get", "update", "--allow-releaseinfo-change"], sudo=True)
+    output, poll = run_sys_command(["sudo", "apt-get", "update", "--allow-releaseinfo-change"], custom_parser=apt_output_parser, sudo=True)
     if poll != 0:
         print_c("ERROR: failed to update package list", TextColors.RED)
         print_c("Please try manually")
@@ -198,25 +1041,198 @@ def update_package_list(backup_path=None):
             cleanup(backup_path)
         bail("Fatal error: Exiting")
 
+    with contextlib.suppress(OSError):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(APT_UPDATE_STAMP, 'w'):
+            pass
+
+
+def package_list_age():
+    """How long ago the apt package list was updated, as far as can be told
+
+    Lists that haven't changed on the server aren't rewritten, so this uses apt's update stamp & the last
+    time this script updated it, as well as when the lists directory was last changed.
+
+    Returns:
+        float: age in seconds, or None if it doesn't look like it has ever been updated
+    """
+    times = []
+    for path in (APT_UPDATE_STAMP, PATH_TO_APT_UPDATE_STAMP, PATH_TO_APT_LISTS, os.path.join(PATH_TO_APT_LISTS, 'partial')):
+        with contextlib.suppress(OSError):
+            times.append(os.path.getmtime(path))
+    return time.time() - max(times) if times else None
+
+
+def refresh_package_list(backup_path=None):
+    """Update the apt package list, unless it was updated less than --package-list-ttl seconds ago"""
+    age = package_list_age()
+    if age is not None and 0 <= age < args.package_list_ttl:
+        print("Package list was updated {} minute(s) ago, not updating it again".format(int(age // 60)))
+        return
+    update_package_list(backup_path)
+
 
-def check_installed_package(package, backup_path=None):
+def check_installed_package(package, backup_path=None, version_requirement=None):
+    """Check if a package is installed, optionally at a version matching version_requirement (eg. '>= 3.7')"""
     print("Checking package list for {}".format(package))
-    output, poll = run_sys_command(["dpkg-query", "-l"])
-    if poll != 0:
+    packages = DpkgStatus.get()
+    if packages is None:
         print_c("ERROR: failed to list installed packages", TextColors.RED)
         if backup_path:
             cleanup(backup_path)
         bail("Fatal error: Exiting")
 
-    else:
-        for line in output:
-            if line.startswith(package, 4):
-                print_c("{} is already installed".format(package), TextColors.GREEN)
-                return True
+    if packages.is_installed(package, version_requirement):
+        print_c("{} is already installed".format(package), TextColors.GREEN)
+        return True
 
     return False
 
 
+# -----------------
+# Installed package state, read from dpkg's database once and answered from memory after that
+# -----------------
+class DpkgStatus:
+    _instance = None
+
+    def __init__(self, packages):
+        # package name -> (status, version)
+        self.packages = packages
+
+    @classmethod
+    def get(cls):
+        """Load the package index the first time it is needed
+
+        Returns:
+            DpkgStatus: package index, or None if the installed packages could not be listed
+        """
+        if cls._instance is None:
+            try:
+                with open(PATH_TO_DPKG_STATUS, 'r', encoding='utf-8', errors='replace') as status_file:
+                    cls._instance = cls(cls.parse(status_file))
+            except OSError:
+                cls._instance = cls.from_dpkg_query()
+        return cls._instance
+
+    @classmethod
+    def invalidate(cls):
+        """Throw away the index, so it is read again after packages are installed"""
+        cls._instance = None
+
+    @staticmethod
+    def parse(lines):
+        """Parse dpkg's status file into a dict of package name -> (status, version)"""
+        packages = {}
+        fields = {}
+        for line in lines:
+            if not line.strip():
+                DpkgStatus._add(packages, fields)
+                fields = {}
+            elif not line[0].isspace() and ':' in line:
+                # Continuation lines (starting with a space) belong to long fields like Description, which aren't needed
+                name, value = line.split(':', 1)
+                fields[name] = value.strip()
+        DpkgStatus._add(packages, fields)
+        return packages
+
+    @staticmethod
+    def _add(packages, fields):
+        if 'Package' not in fields:
+            return
+        # Status is 'want flag state', eg. 'install ok installed'
+        status = fields.get('Status', '').split()[-1:] or ['unknown']
+        entry = (status[0], fields.get('Version'))
+        # Multi-arch packages appear once per architecture, prefer whichever is installed
+        existing = packages.get(fields['Package'])
+        if not existing or existing[0] != 'installed':
+            packages[fields['Package']] = entry
+
+    @classmethod
+    def from_dpkg_query(cls):
+        def parse(line, packages):
+            # Read as it is printed, a full image has thousands of packages
+            packages = packages if packages is not None else {}
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) == 3:
+                cls._add(packages, {'Package': parts[0], 'Status': parts[1], 'Version': parts[2]})
+            return packages
+
+        command = Command(['dpkg-query', '-W', '-f', '${Package}\t${Status}\t${Version}\n'], custom_parser=parse)
+        run_sys_commands([command])
+        if command.poll != 0:
+            return None
+        return cls(command.last_state or {})
+
+    def version(self, package):
+        """Installed version of the package, or None if it is not installed"""
+        status, version = self.packages.get(package, (None, None))
+        return version if status == 'installed' else None
+
+    def is_installed(self, package, version_requirement=None):
+        version = self.version(package)
+        if version is None:
+            return False
+        if not version_requirement:
+            return True
+
+        match = re.match(r"^\s*(<<|<=|=|>=|>>)\s*(\S+)\s*$", version_requirement)
+        if not match:
+            raise ValueError("Invalid version requirement: {}".format(version_requirement))
+        operator, required = match.groups()
+        result = compare_debian_versions(version, required)
+        return {
+            '<<': result < 0,
+            '<=': result <= 0,
+            '=': result == 0,
+            '>=': result >= 0,
+            '>>': result > 0,
+        }[operator]
+
+
+def compare_debian_versions(a, b):
+    """Compare two Debian package versions the same way dpkg does. Returns <0, 0 or >0 like cmp()"""
+    def split(version):
+        epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+        upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '0')
+        return int(epoch or 0), upstream, revision
+
+    def order(char):
+        if not char or char.isdigit():
+            return 0
+        if char.isalpha():
+            return ord(char)
+        if char == '~':
+            return -1
+        return ord(char) + 256
+
+    def compare_part(a, b):
+        i = j = 0
+        while i < len(a) or j < len(b):
+            while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+                a_order = order(a[i] if i < len(a) else '')
+                b_order = order(b[j] if j < len(b) else '')
+                if a_order != b_order:
+                    return a_order - b_order
+                i += 1
+                j += 1
+
+            a_start = i
+            while i < len(a) and a[i].isdigit():
+                i += 1
+            b_start = j
+            while j < len(b) and b[j].isdigit():
+                j += 1
+            a_number = int(a[a_start:i] or 0)
+            b_number = int(b[b_start:j] or 0)
+            if a_number != b_number:
+                return a_number - b_number
+        return 0
+
+    a_epoch, a_upstream, a_revision = split(a)
+    b_epoch, b_upstream, b_revision = split(b)
+    return (a_epoch - b_epoch) or compare_part(a_upstream, b_upstream) or compare_part(a_revision, b_revision)
+
+
 # -----------------
 # Class holding all the checks
 # -----------------
@@ -225,22 +1241,42 @@ class Checks:
         """
         Some checks to run before the majority of the script is executed
         """
+        self.require_linux()
+        self.require_not_root()
+        if not self.requests_installed():
+            self.confirm_without_requests()
+
+    def require_linux(self):
         if not self.is_linux():
             print_c("Sorry, this script needs to be run on Linux :(", TextColors.YELLOW)
             print_c("For other OSes (except Windows), you can create a backup, create a new virtualenv & then restore the backup. Backup & restore is not available on windows.")
             bail("Error: Non linux OS detected. Exiting...")
 
+    def require_not_root(self):
         if not self.is_not_root() and not args.iknowwhatimdoing:
             print_c("This script should not be run as root - please run as your standard user account  (no `sudo`!)", TextColors.YELLOW)
             print_c("Please run the script as it says in the guides, using `python3 upgrade.py`", TextColors.YELLOW)
             bail("Error: Should not be run as root. Exiting...")
 
-        if not self.requests_installed():
-            print_c("The requests dependency is not installed - without this, no plugins are able to be installed.", TextColors.YELLOW)
-            print("You may need to install it with `python3 -m pip install requests` or similar.")
-            print_c("Do you still wish to continue?", TextColors.YELLOW)
-            if not confirm_to_go():
-                bail("Bye!")
+    @staticmethod
+    def confirm_without_requests():
+        print_c("The requests dependency is not installed - without this, no plugins are able to be installed.", TextColors.YELLOW)
+        print("You may need to install it with `python3 -m pip install requests` or similar.")
+        print_c("Do you still wish to continue?", TextColors.YELLOW)
+        if not confirm_to_go():
+            bail("Bye!")
+
+    def require_compatible_octopi(self):
+        """
+        Returns:
+            bool: True if this is OctoPi, which is then known to be compatible
+        """
+        is_octopi = self.is_octopi()
+        if is_octopi and not self.is_octopi_compatible():
+            print_c("Looks like your OctoPi install is not compatible with this script")
+            print_c("Please check your other options for upgrading to Python 3.")
+            bail("Fatal Error: OctoPi not compatible, exiting...")
+        return is_octopi
 
     @staticmethod
     def is_linux():
@@ -252,11 +1288,8 @@ class Checks:
 
     @staticmethod
     def requests_installed():
-        try:
-            import requests  # noqa
-            return True
-        except ImportError:
-            return False
+        # Only looked up rather than imported, importing requests takes longer than the rest of the script
+        return importlib.util.find_spec('requests') is not None
 
     @staticmethod
     def is_octopi():
@@ -291,90 +1324,535 @@ class Checks:
         return valid
 
 
-# ---------------------
-# Actions to take. Roughly in order of execution in the script
-# ---------------------
-def start_text():
-    print("OctoPrint Upgrade to Py 3 (v{})\n".format(SCRIPT_VERSION))
-    print("This script will move your existing OctoPrint configuration from Python 2 to Python 3")
-    print_c("This script requires an internet connection ", TextColors.YELLOW, end='')  # These will print on same line
-    print_c("and it will disrupt any ongoing print jobs.", TextColors.RED, TextStyles.BRIGHT)
-    print("\nIt will install the latest version of OctoPrint and all plugins.")
-    print("No configuration or other files will be overwritten\n")
+# -----------------
+# Pre-flight probes, run at the same time where they don't depend on each other
+# -----------------
+class Probe:
+    """A pre-flight check for run_probes, run once all the probes it requires have passed"""
+    def __init__(self, name, func, *func_args, requires=()):
+        self.name = name
+        self.func = func
+        self.func_args = func_args
+        self.requires = requires
+        self.status = 'pending'
+        self.result = None
 
 
-def test_octoprint_version(venv_path):
-    output, exit_code = run_sys_command(['{}/bin/python'.format(venv_path), '-m', 'octoprint', '--version'])
-    if exit_code != 0 or not output:
-        bail("Failed to find OctoPrint install\n"
-             "If you are not on OctoPi, please check you entered the correct path to your virtual environment")
-    version = re.search(r"(?<=version )(.*)", output[0]).group()
-    version_no = version.split('.')
-    print("OctoPrint version: {}.{}.{}".format(version_no[0], version_no[1], version_no[2]))
-    if int(version_no[0]) >= 1 and int(version_no[1]) >= 4:
-        if "1.5.0rc1" in version:
-            print_c(
-                """Unfortunately OctoPrint 1.5.0rc1 has a bug that prevents using the backup plugin's CLI.
-This is fixed in later releases, so please either update to a newer release, or use OctoPrint 1.4.2
-Since this prevents any further action, this script will now exit""",
-                TextColors.YELLOW)
-            bail("Fatal error: bug in OctoPrint preventing continue. Exiting...")
-        return True
-    else:
-        # This is not strictly needed, but since I am only testing this against OctoPrint 1.4.0 or later
-        # I cannot guarantee behaviour of previous versions, and users should be running something recent anyway.
-        return False
+@EVENTS.phase('run_probes')
+def run_probes(probes):
+    """Run probes on a thread pool, starting each one as soon as the probes it requires have passed
 
+    A probe fails if it bails or raises, and any probes that require it are skipped. Once every probe has
+    finished, the script exits if any failed, so all the problems are reported at once rather than one per run.
 
-def get_env_config(octopi):
-    sys_commands = {}
-    venv_path = None
-    config_base = None
-    if octopi and not FORCE_CUSTOM:
-        venv_path = "/home/pi/oprint"
-        if not os.path.exists(venv_path):
-            print_c("Hmm, seems like you don't have an environment at /home/pi/oprint", TextColors.YELLOW)
-            venv_path = None
+    Returns:
+        dict: the result of each probe by name
+    """
+    by_name = {probe.name: probe for probe in probes}
+    pending = list(probes)
+    running = {}
+
+    def run_probe(probe):
+        with EVENTS.phase('probe_{}'.format(probe.name)):
+            return probe.func(*probe.func_args)
+
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        while pending or running:
+            for probe in list(pending):
+                statuses = [by_name[name].status for name in probe.requires]
+                if any(status in ('failed', 'skipped') for status in statuses):
+                    probe.status = 'skipped'
+                    pending.remove(probe)
+                elif all(status == 'ok' for status in statuses):
+                    running[executor.submit(EVENTS.wrap(run_probe), probe)] = probe
+                    pending.remove(probe)
+            if not running:
+                continue
+
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                probe = running.pop(future)
+                try:
+                    probe.result = future.result()
+                    probe.status = 'ok'
+                except SystemExit:
+                    # bail() has already said what went wrong
+                    probe.status = 'failed'
+                except Exception as e:
+                    print_c("ERROR: {} check failed: {}".format(probe.name, e), TextColors.RED)
+                    probe.status = 'failed'
+
+    failed = [probe.name for probe in probes if probe.status == 'failed']
+    if failed:
+        skipped = [probe.name for probe in probes if probe.status == 'skipped']
+        print("")
+        print_c("Pre-flight checks failed: {}".format(", ".join(failed)), TextColors.RED)
+        if skipped:
+            print("Not checked, as they depend on a failed check: {}".format(", ".join(skipped)))
+        bail("Fatal Error: Exiting")
+    return {probe.name: probe.result for probe in probes}
 
-        if venv_path and not check_venv_python(venv_path):
-            print_c("Virtual environment is already Python 3, are you sure you need an upgrade?\n", TextColors.YELLOW)
-            print_c("If you'd rather upgrade a different virtual env, you can enter the full path here", TextColors.YELLOW)
-            venv_path = None
 
-        while not venv_path:
-            try:
-                path = input("Virtual environment path: ")
-            except KeyboardInterrupt:
-                bail("Bye!")
-            if not path:
-                print("Please enter a path!")
+# -----------------
+# Offline wheelhouse, so OctoPrint & plugins can be built once and installed on many machines
+# -----------------
+class Wheelhouse:
+    MANIFEST = 'wheelhouse.json'
+
+    def __init__(self, path, temporary=False):
+        self.path = path
+        self.wheel_dir = os.path.join(path, 'wheels')
+        self.temporary = temporary
+        with open(os.path.join(path, self.MANIFEST), 'r') as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+    @classmethod
+    def open(cls, path):
+        """Open a wheelhouse directory, or extract a wheelhouse tarball to a temporary directory"""
+        if os.path.isdir(path):
+            return cls(path)
+
+        import tarfile
+        target = tempfile.mkdtemp(prefix="octoprint-upgrade-wheelhouse-")
+        with tarfile.open(path, 'r:*') as tar:
+            if hasattr(tarfile, 'data_filter'):
+                try:
+                    tar.extractall(target, filter='data')
+                except tarfile.FilterError as e:
+                    shutil.rmtree(target, ignore_errors=True)
+                    bail("Fatal Error: {} is not a valid wheelhouse: {}".format(path, e))
             else:
-                if os.path.isfile("{}/bin/python".format(path)):
-                    valid = check_venv_python(path)
-                    if valid:
-                        venv_path = path
-                        print_c("Path valid", TextColors.GREEN)
-                    else:
-                        print_c("Virtual environment is already Python 3, are you sure you need an upgrade?\n"
-                                "Please try again", TextColors.YELLOW)
-                else:
-                    print_c("Invalid venv path, please try again", TextColors.YELLOW)
-                if path.endswith('/'):
-                    print_c("Please enter your path without a trailing slash", TextColors.YELLOW)
-                    venv_path = None
+                # Pythons without extraction filters would follow absolute paths, '..' and links out of the directory
+                root = os.path.realpath(target)
+                members = tar.getmembers()
+                for member in members:
+                    destination = os.path.realpath(os.path.join(root, member.name))
+                    if not (member.isfile() or member.isdir()) or os.path.commonpath([root, destination]) != root:
+                        shutil.rmtree(target, ignore_errors=True)
+                        bail("Fatal Error: {} is not a valid wheelhouse: unexpected member {}".format(path, member.name))
+                tar.extractall(target, members=members)
+        return cls(target, temporary=True)
+
+    def check_compatible(self):
+        python_version = "{}.{}".format(*sys.version_info[:2])
+        if self.manifest['python'] != python_version or self.manifest['machine'] != os.uname().machine:
+            print_c("Warning: The wheelhouse was built for Python {} on {}, this is Python {} on {}".format(
+                self.manifest['python'], self.manifest['machine'], python_version, os.uname().machine), TextColors.YELLOW)
+            print_c("Packages that don't match will be downloaded instead", TextColors.YELLOW)
+
+    def take_plugins(self, plugin_keys):
+        """Find plugin wheels in the wheelhouse, removing the keys found from plugin_keys
+
+        Returns:
+            list: tuples of (plugin, path to wheel), the same as build_plugin_wheels
+        """
+        wheels = []
+        for key in list(plugin_keys):
+            plugin = self.manifest['plugins'].get(key)
+            if plugin:
+                wheels.append(({'id': key, 'url': plugin['url'], 'name': plugin['name']}, os.path.join(self.path, plugin['wheel'])))
+                plugin_keys.remove(key)
+        return wheels
 
-        sys_commands['stop'] = "sudo service octoprint stop"
-        sys_commands['start'] = "sudo service octoprint start"
-        config_base = "/home/pi/.octoprint"
-    else:
-        print("Please provide the path to your virtual environment and the config directory of OctoPrint")
-        print("On OctoPi, this would be `/home/pi/oprint` (for the venv), `/home/pi/.octoprint` (for config)\n"
-              "and service commands commands `sudo service octoprint stop/start`")
-        while not venv_path:
-            try:
-                path = input("Virtual environment path: ")
-            except KeyboardInterrupt:
-                bail("Bye!")
+    def cleanup(self):
+        if self.temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def build_wheelhouse(output_path, backup_path):
+    """Build wheels for OctoPrint, the plugins in the backup & all their dependencies
+
+    The wheels are built in a scratch venv using this Python, so they match the Python & platform
+    of machines that are the same as this one.
+
+    Args:
+        output_path (str): directory to create the wheelhouse in, or a .tar.gz/.tgz file
+        backup_path (str): OctoPrint backup zip to read the plugin list from
+    """
+    try:
+        plugin_list = load_plugin_list(backup_path) or []
+    except FileNotFoundError:
+        bail("Error: Could not read backup {}".format(backup_path))
+    plugin_keys = [plugin['key'] for plugin in plugin_list]
+
+    tarball = output_path.endswith('.tar.gz') or output_path.endswith('.tgz')
+    build_dir = tempfile.mkdtemp(prefix="octoprint-upgrade-wheelhouse-") if tarball else output_path
+    built = populate_wheelhouse(build_dir, plugin_keys)
+
+    if tarball:
+        import tarfile
+        print("Creating {}...".format(output_path))
+        with tarfile.open(output_path, 'w:gz') as tar:
+            tar.add(build_dir, arcname='.')
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    print_c("Wheelhouse created at {} with {} plugin(s)".format(output_path, len(built)), TextColors.GREEN)
+    if plugin_keys:
+        print_c("These plugins were not found on the repo, so are not included", TextColors.YELLOW)
+        for not_found_plugin in plugin_keys:
+            print("- {}".format(not_found_plugin))
+
+
+@EVENTS.phase('populate_wheelhouse')
+def populate_wheelhouse(build_dir, plugin_keys):
+    """Build OctoPrint, the plugins & all their dependencies into build_dir, and write the manifest
+
+    Keys of plugins found on the plugin repo are removed from plugin_keys.
+
+    Returns:
+        list: tuples of (plugin, path to wheel) for the plugins that are in the wheelhouse
+    """
+    wheel_dir = os.path.join(build_dir, 'wheels')
+    plugin_dir = os.path.join(build_dir, 'plugins')
+    os.makedirs(wheel_dir, exist_ok=True)
+
+    scratch_venv = tempfile.mkdtemp(prefix="octoprint-upgrade-venv-")
+    try:
+        print("Creating build environment...")
+        output, poll = run_sys_command(['python3', '-m', 'venv', scratch_venv])
+        if poll != 0:
+            bail("Fatal error: Could not create build environment")
+        run_sys_command(['{}/bin/python'.format(scratch_venv), '-m', 'pip', 'install', '--upgrade', 'pip', 'wheel'])
+
+        pip_wheel = ['{}/bin/python'.format(scratch_venv), '-m', 'pip', 'wheel', '--wheel-dir', wheel_dir]
+        print("Building OctoPrint & dependencies... ", end="")
+        print_c("(This may take a while)", TextColors.YELLOW)
+        output, poll = run_sys_command(pip_wheel + ['pip', 'wheel', 'OctoPrint'], custom_parser=pip_output_parser)
+        if poll != 0:
+            bail("Fatal error: Failed to build OctoPrint wheels")
+
+        built = []
+        if plugin_keys:
+            # Most plugins' setup.py imports octoprint_setuptools, so OctoPrint has to be installed to build them
+            output, poll = run_sys_command(['{}/bin/python'.format(scratch_venv), '-m', 'pip', 'install', '--no-index',
+                                            '--find-links', wheel_dir, 'OctoPrint'], custom_parser=pip_output_parser)
+            if poll != 0:
+                print_c("Warning: Could not install OctoPrint to build plugins with, plugins that need it will fail to build",
+                        TextColors.YELLOW)
+            plugins, incompatible = split_incompatible_plugins(match_plugins(fetch_plugin_repo() or {}, plugin_keys),
+                                                               read_octoprint_version(scratch_venv))
+            report_incompatible_plugins(incompatible)
+            built, build_errors = build_plugin_wheels(scratch_venv, plugins, plugin_dir, args.jobs)
+            for plugin in build_errors:
+                print_c("Plugin {} will not be in the wheelhouse".format(plugin['name']), TextColors.YELLOW)
+
+        if built:
+            print("Building plugin dependencies...")
+            output, poll = run_sys_command(pip_wheel + [wheel for plugin, wheel in built], custom_parser=pip_output_parser)
+            if poll != 0:
+                # Find out which plugin's dependencies can't be built, so the rest still make it in
+                for plugin, wheel in list(built):
+                    output, poll = run_sys_command(pip_wheel + [wheel], custom_parser=pip_output_parser)
+                    if poll != 0:
+                        print_c("Plugin {} will not be in the wheelhouse".format(plugin['name']), TextColors.YELLOW)
+                        built.remove((plugin, wheel))
+    finally:
+        shutil.rmtree(scratch_venv, ignore_errors=True)
+
+    manifest = {
+        'python': "{}.{}".format(*sys.version_info[:2]),
+        'machine': os.uname().machine,
+        'plugins': {
+            plugin['id']: {
+                'name': plugin['name'],
+                'url': plugin['url'],
+                'wheel': os.path.join('wheels', os.path.basename(wheel))
+            } for plugin, wheel in built
+        },
+    }
+    with open(os.path.join(build_dir, Wheelhouse.MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    # Plugin wheels have been copied into the wheel dir by pip
+    shutil.rmtree(plugin_dir, ignore_errors=True)
+    return built
+
+
+# -----------------
+# Pre-flight dependency resolution, so problems are found before OctoPrint is stopped
+# -----------------
+def resolve_requirements(venv_path, requirements, report_path, wheelhouse=None):
+    """Resolve requirements with `pip install --dry-run --report`, without installing anything
+
+    Returns:
+        dict: pip's installation report, or None if the requirements could not be resolved
+        list: output lines from pip
+    """
+    command = ['{}/bin/python'.format(venv_path), '-m', 'pip', 'install', '--dry-run', '--ignore-installed',
+               '--report', report_path]
+    if wheelhouse:
+        command += ['--find-links', wheelhouse.wheel_dir]
+    output, poll = run_sys_command(command + requirements, show_stderr=False, watch=['^ERROR'])
+    if poll != 0 or not os.path.isfile(report_path):
+        return None, output
+    with open(report_path, 'r') as report_file:
+        return json.load(report_file), output
+
+
+def describe_resolve_failure(output):
+    """Turn pip's output from a failed resolve into a short reason
+
+    Returns:
+        str: the reason
+        bool: True if the requirements really can't be installed, False if pip couldn't tell (eg. a build failed)
+    """
+    text = "".join(output)
+    certain = True
+    if 'ResolutionImpossible' in text or 'conflict' in text.lower():
+        reason = "conflicting dependencies"
+    elif 'requires a different Python' in text or 'No matching distribution' in text:
+        reason = "a dependency is not available for this Python version"
+    else:
+        reason = "failed to build"
+        certain = False
+    errors = [line.strip() for line in output if line.startswith('ERROR')]
+    return "{}{}".format(reason, ": {}".format(errors[0]) if errors else ""), certain
+
+
+def fetch_download_sizes(urls):
+    """Find the size of each download with HEAD requests, in parallel
+
+    Returns:
+        int: total bytes of the downloads that reported a size
+        int: number of downloads with an unknown size
+    """
+    try:
+        import requests
+    except ImportError:
+        return 0, len(urls)
+
+    def size(url):
+        try:
+            response = requests.head(url, allow_redirects=True, timeout=10)
+            return int(response.headers['Content-Length']) if response.ok else None
+        except (requests.exceptions.RequestException, KeyError, ValueError):
+            return None
+
+    if not urls:
+        return 0, 0
+    with ThreadPoolExecutor(max_workers=min(16, len(urls))) as executor:
+        sizes = list(executor.map(size, urls))
+    return sum(s for s in sizes if s), len([s for s in sizes if s is None])
+
+
+def save_constraints(report):
+    """Pin every package in the resolution in a constraints file, for the real install to reuse
+
+    Plugins installed from archive URLs can't be used as constraints, so only index packages are pinned.
+
+    Returns:
+        str: path to the constraints file, or None if it could not be written
+    """
+    pins = sorted("{}=={}".format(item['metadata']['name'], item['metadata']['version'])
+                  for item in report.get('install', []) if not item.get('is_direct'))
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(RESOLVED_CONSTRAINTS, 'w') as constraints_file:
+            constraints_file.write("# Resolved by upgrade.py --resolve-first for Python {}\n".format('.'.join(map(str, sys.version_info[:3]))))
+            constraints_file.write("\n".join(pins) + "\n")
+    except OSError:
+        print_c("Warning: Could not save the resolved dependencies, the install will resolve them again", TextColors.YELLOW)
+        return None
+    return RESOLVED_CONSTRAINTS
+
+
+@EVENTS.phase('resolve_dependencies')
+def resolve_dependencies(plugin_keys, backup_path, wheelhouse=None):
+    """Resolve OctoPrint & every plugin against Python 3 before anything is changed
+
+    Plugins that can't be resolved are reported and removed from plugin_keys once confirmed, so no time is
+    spent on them while OctoPrint is stopped. Plugins that couldn't be checked, because pip couldn't build
+    them to read their dependencies, are reported but still installed. If OctoPrint itself can't be resolved,
+    the upgrade stops here.
+
+    Returns:
+        str: path to a constraints file pinning the resolved versions, or None
+    """
+    print("\nResolving dependencies of OctoPrint & plugins before making any changes...")
+    scratch_venv = tempfile.mkdtemp(prefix="octoprint-upgrade-resolve-")
+    report_dir = tempfile.mkdtemp(prefix="octoprint-upgrade-report-")
+    try:
+        output, poll = run_sys_command(['python3', '-m', 'venv', scratch_venv])
+        if poll != 0:
+            print_c("Warning: Could not create an environment to resolve dependencies in, skipping", TextColors.YELLOW)
+            return None
+        # --dry-run & --report need pip 22.2+, newer than Debian's. Without wheel, pip builds plugins' setup.py
+        # in an isolated environment, where octoprint_setuptools can't be imported
+        pip_install(scratch_venv, ['--upgrade', 'pip', 'wheel'], wheelhouse)
+        if not pip_supports_dry_run(scratch_venv):
+            print_c("Warning: pip 22.2 or newer is needed to resolve dependencies without installing them, skipping",
+                    TextColors.YELLOW)
+            return None
+        install_octoprint_setuptools(scratch_venv, wheelhouse)
+
+        plugins = []
+        if plugin_keys:
+            # Incompatible plugins are left in plugin_keys, so they are reported when they would be installed
+            plugins, incompatible = split_incompatible_plugins(match_plugins(fetch_plugin_repo() or {}, list(plugin_keys)))
+
+        report, output = resolve_requirements(scratch_venv, ['OctoPrint'] + [plugin['url'] for plugin in plugins],
+                                              os.path.join(report_dir, 'all.json'), wheelhouse)
+        failed = []
+        unchecked = []
+        if report is None:
+            report, output = resolve_requirements(scratch_venv, ['OctoPrint'], os.path.join(report_dir, 'octoprint.json'), wheelhouse)
+            if report is None:
+                print_c("ERROR: OctoPrint's dependencies can't be resolved on Python 3 ({})".format(describe_resolve_failure(output)[0]),
+                        TextColors.RED)
+                print("Nothing has been changed, your existing install is untouched")
+                cleanup(backup_path)
+                bail("Fatal Error: Exiting")
+
+            def resolve_plugin(plugin):
+                return resolve_requirements(scratch_venv, ['OctoPrint', plugin['url']],
+                                            os.path.join(report_dir, '{}.json'.format(plugin['id'])), wheelhouse)
+
+            # Find which plugins are the problem, each one resolved against OctoPrint on its own
+            with ThreadPoolExecutor(max_workers=max(1, min(args.jobs, len(plugins)))) as executor:
+                results = list(executor.map(EVENTS.wrap(resolve_plugin), plugins))
+            for plugin, (plugin_report, plugin_output) in zip(plugins, results):
+                if plugin_report is None:
+                    reason, certain = describe_resolve_failure(plugin_output)
+                    (failed if certain else unchecked).append((plugin, reason))
+
+            good = [plugin for plugin in plugins if plugin not in [f[0] for f in failed + unchecked]]
+            combined, output = resolve_requirements(scratch_venv, ['OctoPrint'] + [plugin['url'] for plugin in good],
+                                                    os.path.join(report_dir, 'good.json'), wheelhouse)
+            if combined is not None:
+                report = combined
+            else:
+                print_c("Warning: These plugins resolve on their own but not together, pip will choose between them during the install",
+                        TextColors.YELLOW)
+    finally:
+        shutil.rmtree(scratch_venv, ignore_errors=True)
+        shutil.rmtree(report_dir, ignore_errors=True)
+
+    packages = report.get('install', [])
+    urls = [item['download_info']['url'] for item in packages
+            if item.get('download_info', {}).get('url', '').startswith(('http://', 'https://'))]
+    total, unknown = fetch_download_sizes(urls)
+    print_c("Resolved {} package(s) for Python 3, about {:.1f} MB to download{}".format(
+        len(packages), total / (1024 * 1024), " ({} of unknown size)".format(unknown) if unknown else ""), TextColors.GREEN)
+
+    if unchecked:
+        print_c("The dependencies of these plugins couldn't be checked, they will still be installed:", TextColors.YELLOW)
+        for plugin, reason in unchecked:
+            print("- {}: {}".format(plugin['name'], reason))
+
+    if failed:
+        print_c("These plugins can't be installed on Python 3:", TextColors.YELLOW)
+        for plugin, reason in failed:
+            print("- {}: {}".format(plugin['name'], reason))
+        if not confirm_to_go("Press [enter] to upgrade without them, or ctrl-c to quit"):
+            cleanup(backup_path)
+            bail("Bye!")
+        for plugin, reason in failed:
+            plugin_keys.remove(plugin['id'])
+
+    return save_constraints(report)
+
+
+# ---------------------
+# Actions to take. Roughly in order of execution in the script
+# ---------------------
+def start_text():
+    print("OctoPrint Upgrade to Py 3 (v{})\n".format(SCRIPT_VERSION))
+    print("This script will move your existing OctoPrint configuration from Python 2 to Python 3")
+    print_c("This script requires an internet connection ", TextColors.YELLOW, end='')  # These will print on same line
+    print_c("and it will disrupt any ongoing print jobs.", TextColors.RED, TextStyles.BRIGHT)
+    print("\nIt will install the latest version of OctoPrint and all plugins.")
+    print("No configuration or other files will be overwritten\n")
+
+
+@EVENTS.phase('test_octoprint_version')
+def test_octoprint_version(venv_path):
+    version = read_octoprint_version(venv_path)
+    if not version:
+        # No metadata to read, so ask OctoPrint itself - this is slow, as it imports everything
+        output, exit_code = run_sys_command(['{}/bin/python'.format(venv_path), '-m', 'octoprint', '--version'],
+                                            watch=[r"version \S+"])
+        match = None
+        for line in output if exit_code == 0 else []:
+            match = re.search(r"version (\S+)", line)
+            if match:
+                break
+        if not match:
+            bail("Failed to find OctoPrint install\n"
+                 "If you are not on OctoPi, please check you entered the correct path to your virtual environment")
+        version = match.group(1)
+
+    match = re.match(r"(\d+)\.(\d+)", version)
+    if not match:
+        bail("Could not understand OctoPrint version {}".format(version))
+    print("OctoPrint version: {}".format(version))
+    if (int(match.group(1)), int(match.group(2))) >= (1, 4):
+        if "1.5.0rc1" in version:
+            print_c(
+                """Unfortunately OctoPrint 1.5.0rc1 has a bug that prevents using the backup plugin's CLI.
+This is fixed in later releases, so please either update to a newer release, or use OctoPrint 1.4.2
+Since this prevents any further action, this script will now exit""",
+                TextColors.YELLOW)
+            bail("Fatal error: bug in OctoPrint preventing continue. Exiting...")
+        return True
+    else:
+        # This is not strictly needed, but since I am only testing this against OctoPrint 1.4.0 or later
+        # I cannot guarantee behaviour of previous versions, and users should be running something recent anyway.
+        return False
+
+
+def require_octoprint_140(venv_path):
+    if not test_octoprint_version(venv_path):
+        bail("Please upgrade to an OctoPrint version >= 1.4.0 for Python 3 compatibility")
+
+
+def get_env_config(octopi):
+    sys_commands = {}
+    venv_path = None
+    config_base = None
+    if octopi and not FORCE_CUSTOM:
+        venv_path = "/home/pi/oprint"
+        if not os.path.exists(venv_path):
+            print_c("Hmm, seems like you don't have an environment at /home/pi/oprint", TextColors.YELLOW)
+            venv_path = None
+
+        if venv_path and not check_venv_python(venv_path):
+            print_c("Virtual environment is already Python 3, are you sure you need an upgrade?\n", TextColors.YELLOW)
+            print_c("If you'd rather upgrade a different virtual env, you can enter the full path here", TextColors.YELLOW)
+            venv_path = None
+
+        while not venv_path:
+            try:
+                path = input("Virtual environment path: ")
+            except KeyboardInterrupt:
+                bail("Bye!")
+            if not path:
+                print("Please enter a path!")
+            else:
+                if os.path.isfile("{}/bin/python".format(path)):
+                    valid = check_venv_python(path)
+                    if valid:
+                        venv_path = path
+                        print_c("Path valid", TextColors.GREEN)
+                    else:
+                        print_c("Virtual environment is already Python 3, are you sure you need an upgrade?\n"
+                                "Please try again", TextColors.YELLOW)
+                else:
+                    print_c("Invalid venv path, please try again", TextColors.YELLOW)
+                if path.endswith('/'):
+                    print_c("Please enter your path without a trailing slash", TextColors.YELLOW)
+                    venv_path = None
+
+        sys_commands['stop'] = "sudo service octoprint stop"
+        sys_commands['start'] = "sudo service octoprint start"
+        config_base = "/home/pi/.octoprint"
+    else:
+        print("Please provide the path to your virtual environment and the config directory of OctoPrint")
+        print("On OctoPi, this would be `/home/pi/oprint` (for the venv), `/home/pi/.octoprint` (for config)\n"
+              "and service commands commands `sudo service octoprint stop/start`")
+        while not venv_path:
+            try:
+                path = input("Virtual environment path: ")
+            except KeyboardInterrupt:
+                bail("Bye!")
             if not path:
                 print("Please enter a path!")
             else:
@@ -417,7 +1895,18 @@ def get_env_config(octopi):
     return venv_path, sys_commands, config_base
 
 
+@EVENTS.phase('check_venv_python')
 def check_venv_python(venv_path):
+    """Check the venv is Python 2, reading its version from disk & only running its python if that doesn't work
+
+    Returns:
+        bool: True if the venv is Python 2
+    """
+    version = read_venv_python_version(venv_path)
+    if version:
+        print("Found version: Python {}".format(".".join(str(part) for part in version)))
+        return version[0] == 2
+
     version_output, poll = get_python_version(venv_path)
     for line in version_output:
         # Debian has the python version set to 2.7.15+ which is not PEP440 compliant (bug 914072)
@@ -427,22 +1916,89 @@ def check_venv_python(venv_path):
 
         print("Found version: {}".format(line))
 
-        match = re.search(r"^Python (?P<major>0|[1-9]\d*)\.(?P<minor>0|[1-9]\d*)\.(?P<patch>0|[1-9]\d*)(?:-(?P<prerelease>(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*))?(?:\+(?P<buildmetadata>[0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?", line)
-        if match:  # This should catch the NoneType errors, but *just in case* it is here.
-            try:
-                major = match.group('major')
-                if int(major) == 2:
-                    return True
-                elif int(major) == 3:
-                    return False
-            except AttributeError:  # this line was not able to be parsed, we hand over to the next or say its not working
-                pass
+        match = re.search(r"^Python (?P<major>\d+)\.(?P<minor>\d+)", line)
+        if match:
+            major = int(match.group('major'))
+            if major == 2:
+                return True
+            elif major == 3:
+                return False
 
     print_c("Unable to parse Python version string. Please report to me the line below that has caused problems....", TextColors.YELLOW)
-    print(version_output)
+    print(list(version_output))
     return False
 
 
+def read_venv_python_version(venv_path):
+    """Find the Python version of a venv from pyvenv.cfg, the interpreter symlink or the lib/pythonX.Y directory
+
+    Returns:
+        tuple: (major, minor), or None if none of them say
+    """
+    # venv & virtualenv 20+ write the version here, older virtualenvs (usual for Python 2) don't have the file
+    try:
+        with open(os.path.join(venv_path, 'pyvenv.cfg'), 'r') as config:
+            for line in config:
+                key, _, value = line.partition('=')
+                if key.strip() in ('version', 'version_info'):
+                    match = re.match(r"(\d+)\.(\d+)", value.strip())
+                    if match:
+                        return int(match.group(1)), int(match.group(2))
+    except OSError:
+        pass
+
+    # bin/python is usually a chain of symlinks ending at eg. /usr/bin/python2.7
+    path = os.path.join(venv_path, 'bin', 'python')
+    for _ in range(10):
+        match = re.match(r"python(\d)\.(\d+)$", os.path.basename(path))
+        if match:
+            return int(match.group(1)), int(match.group(2))
+        if not os.path.islink(path):
+            break
+        path = os.path.join(os.path.dirname(path), os.readlink(path))
+
+    versions = [os.path.basename(os.path.dirname(site_packages))[len('python'):] for site_packages in find_site_packages(venv_path)]
+    if len(versions) == 1:
+        match = re.match(r"(\d)\.(\d+)$", versions[0])
+        if match:
+            return int(match.group(1)), int(match.group(2))
+    return None
+
+
+def read_octoprint_version(venv_path):
+    """Read the installed OctoPrint version from its package metadata in the venv
+
+    Returns:
+        str: version, or None if OctoPrint's metadata couldn't be found
+    """
+    return read_package_version(venv_path, 'octoprint')
+
+
+def read_package_version(venv_path, package):
+    """Read the installed version of a package from its metadata in the venv
+
+    Returns:
+        str: version, or None if the package's metadata couldn't be found
+    """
+    for site_packages in find_site_packages(venv_path):
+        for metadata_dir, metadata_file in find_distribution_metadata(site_packages):
+            path = os.path.join(metadata_dir, metadata_file)
+            name = read_metadata_field(path, 'Name')
+            if name and name.lower() == package:
+                return read_metadata_field(path, 'Version')
+    return None
+
+
+def pip_supports_dry_run(venv_path):
+    """Whether the venv's pip has `install --dry-run` & `--report`, which need pip 22.2+
+
+    Python 3.6 can't go past pip 21.3, so there they are never available.
+    """
+    release = parse_release(read_package_version(venv_path, 'pip') or '')
+    return release is not None and compare_releases(release, (22, 2)) >= 0
+
+
+@EVENTS.phase('create_backup')
 def create_backup(venv_path, config_path):
     """Create OctoPrint backup and return the path to it
 
@@ -453,11 +2009,9 @@ def create_backup(venv_path, config_path):
     Returns:
         str: path to backup zip file
     """
-    print("Reading installed plugins...")
-
     command = ["{}/bin/python".format(venv_path), "-m", "octoprint", "--basedir", config_path, "plugins", "backup:backup", "--exclude",
                "timelapse", "--exclude", "uploads"]
-    output, poll = run_sys_command(command)
+    output, poll = run_sys_command(command, watch=['Creating backup at'])
     if poll != 0:
         print_c("ERROR: Failed to create OctoPrint backup", TextColors.RED)
         bail("Fatal error, exiting")
@@ -477,27 +2031,160 @@ def create_backup(venv_path, config_path):
     return backup_path
 
 
+def make_backup(venv_path, config_path, plugin_list):
+    """Create the backup that is kept after the upgrade: a snapshot with --snapshot, or OctoPrint's backup zip
+
+    Returns:
+        str: path to the snapshot directory or backup zip
+    """
+    if args.snapshot:
+        return create_snapshot(config_path, plugin_list, read_octoprint_version(venv_path))
+    return create_backup(venv_path, config_path)
+
+
+# Same as OctoPrint's backups, which also leave out timelapses & uploads when run by create_backup
+SNAPSHOT_EXCLUDES = ('data/backup', 'generated', 'logs', 'watched', 'timelapse', 'uploads')
+FICLONE = 0x40049409
+
+
+class SnapshotCopier:
+    """Copies files for a snapshot as cheaply as the filesystem allows
+
+    Reflinks (btrfs, xfs...) share data until either copy changes, so they are tried first. Otherwise files are
+    hardlinked - OctoPrint replaces its config files when saving rather than writing into them, so the snapshot
+    keeps the old contents. Plugins can write into files under copy_dirs, such as SQLite databases in data/, so
+    those are never hardlinked. Only if neither works (eg. a different filesystem) are files copied.
+    """
+    def __init__(self, copy_dirs=()):
+        self.copy_dirs = [os.path.join(directory, '') for directory in copy_dirs]
+        self.reflinks = True
+        self.hardlinks = True
+        self.counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+
+    def copy(self, src, dst):
+        if self.reflinks:
+            try:
+                import fcntl
+                with open(src, 'rb') as source, open(dst, 'wb') as target:
+                    fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                shutil.copystat(src, dst)
+                self.counts['reflink'] += 1
+                return dst
+            except (ImportError, OSError):
+                # Not supported by this filesystem, don't try again for every file
+                self.reflinks = False
+                with contextlib.suppress(OSError):
+                    os.remove(dst)
+
+        if self.hardlinks and not any(src.startswith(directory) for directory in self.copy_dirs):
+            try:
+                os.link(src, dst)
+                self.counts['hardlink'] += 1
+                return dst
+            except OSError:
+                self.hardlinks = False
+
+        shutil.copy2(src, dst)
+        self.counts['copy'] += 1
+        return dst
+
+
+@EVENTS.phase('create_snapshot')
+def create_snapshot(config_path, plugin_list, octoprint_version=None):
+    """Snapshot the config directory using reflinks or hardlinks, rather than compressing it into a zip
+
+    The layout is the same as OctoPrint's backup zips - the config directory under `basedir`, with
+    `plugin_list.json` & `metadata.json` next to it - so archive_snapshot can turn it into a backup that
+    OctoPrint can restore.
+
+    Returns:
+        str: path to the snapshot directory
+    """
+    snapshot_path = os.path.join(config_path, 'data', 'backup', 'octoprint-snapshot-{}'.format(time.strftime('%Y%m%d-%H%M%S')))
+    excludes = [os.path.join(config_path, exclude) for exclude in SNAPSHOT_EXCLUDES]
+    copier = SnapshotCopier(copy_dirs=[os.path.join(config_path, 'data')])
+
+    def ignore(directory, names):
+        return [name for name in names if os.path.join(directory, name) in excludes]
+
+    try:
+        shutil.copytree(config_path, os.path.join(snapshot_path, 'basedir'), symlinks=True, ignore=ignore,
+                        copy_function=copier.copy)
+        with open(os.path.join(snapshot_path, 'plugin_list.json'), 'w') as plugin_file:
+            json.dump(plugin_list, plugin_file)
+        # OctoPrint won't restore a backup without this, the excludes are the ones create_backup uses
+        with open(os.path.join(snapshot_path, 'metadata.json'), 'w') as metadata_file:
+            json.dump({'version': octoprint_version or 'unknown', 'excludes': ['timelapse', 'uploads']}, metadata_file)
+    except (OSError, shutil.Error) as e:
+        print_c("ERROR: Failed to create snapshot: {}".format(e), TextColors.RED)
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        bail("Fatal error, exiting")
+
+    print("Snapshot used {} reflink(s), {} hardlink(s) & {} copies".format(
+        copier.counts['reflink'], copier.counts['hardlink'], copier.counts['copy']))
+    return snapshot_path
+
+
+@EVENTS.phase('archive_snapshot')
+def archive_snapshot(snapshot_path):
+    """Zip up a snapshot into a backup OctoPrint can restore, once the upgrade is done & time doesn't matter
+
+    Returns:
+        str: path to the zip
+    """
+    print("Archiving snapshot {}...".format(snapshot_path))
+    zip_path = shutil.make_archive(snapshot_path, 'zip', root_dir=snapshot_path)
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    print_c("Backup created at {}".format(zip_path), TextColors.GREEN)
+    return zip_path
+
+
+def load_plugin_list(backup_path):
+    """Load the plugin list from a backup zip or snapshot directory
+
+    Returns:
+        list: plugins in the backup, or None if there is no plugin list in it
+    """
+    if os.path.isdir(backup_path):
+        try:
+            with open(os.path.join(backup_path, 'plugin_list.json'), 'r') as plugins:
+                return json.load(plugins)
+        except FileNotFoundError:
+            return None
+
+    import zipfile
+    with zipfile.ZipFile(backup_path, 'r') as zip_ref:
+        try:
+            zip_ref.getinfo("plugin_list.json")
+        except KeyError:
+            # no plugin list
+            return None
+        # read in list
+        with zip_ref.open("plugin_list.json") as plugins:
+            return json.load(plugins)
+
+
 def read_plugins_from_backup(backup_path):
     # Load plugin list from zip
     # Wrapped in a try block, to catch people who run as root and slip through the check
     # so we can yell at them again
     try:
-        with zipfile.ZipFile(backup_path, 'r') as zip_ref:
-            try:
-                zip_ref.getinfo("plugin_list.json")
-            except KeyError:
-                # no plugin list
-                plugin_list = None
-            else:
-                # read in list
-                with zip_ref.open("plugin_list.json") as plugins:
-                    plugin_list = json.load(plugins)
+        plugin_list = load_plugin_list(backup_path)
     except FileNotFoundError:
         print_c("Failed to read created backup & plugins list", TextColors.YELLOW)
         print_c("If you ran this script using root (`sudo`), please make sure you don't, and run using `python3 upgrade.py`, as per the guide.", TextColors.YELLOW)
         print_c("The other reason this may happen is if you are not running as the same user OctoPrint is installed as/runs under.", TextColors.YELLOW)
         bail("Error: Could not read backup")
 
+    return confirm_plugin_list(plugin_list, backup_path)
+
+
+def confirm_plugin_list(plugin_list, backup_path=None):
+    """Show the plugins that will be installed & wait for confirmation
+
+    Returns:
+        list: keys of the plugins to install
+    """
     plugin_keys = []
     if plugin_list:
         print("\nPlugins installed")
@@ -517,6 +2204,101 @@ def read_plugins_from_backup(backup_path):
     return plugin_keys
 
 
+def find_site_packages(venv_path):
+    """Find the site-packages directories of a venv, whatever Python version it is"""
+    return sorted(glob.glob(os.path.join(venv_path, 'lib', 'python*', 'site-packages')))
+
+
+def read_metadata_field(path, field):
+    """Read a header field (eg. 'Name') from a METADATA or PKG-INFO file"""
+    prefix = field + ':'
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as metadata:
+            for line in metadata:
+                if not line.strip():
+                    # End of the headers, the description follows
+                    break
+                if line.startswith(prefix):
+                    return line[len(prefix):].strip()
+    except OSError:
+        pass
+    return None
+
+
+def read_plugin_entry_points(path):
+    """Read the keys registered under the `octoprint.plugin` group in an entry_points.txt"""
+    keys = []
+    section = None
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as entry_points:
+            for line in entry_points:
+                line = line.strip()
+                if line.startswith('[') and line.endswith(']'):
+                    section = line[1:-1].strip()
+                elif section == 'octoprint.plugin' and '=' in line and not line.startswith(('#', ';')):
+                    keys.append(line.split('=', 1)[0].strip())
+    except OSError:
+        pass
+    return keys
+
+
+def find_distribution_metadata(site_packages):
+    """Find the metadata directories of everything installed in site-packages
+
+    Covers wheels (.dist-info), setuptools installs (.egg-info), eggs (.egg/EGG-INFO) & develop installs (.egg-link)
+
+    Returns:
+        list: tuples of (metadata directory, metadata file name)
+    """
+    found = []
+    for name in os.listdir(site_packages):
+        path = os.path.join(site_packages, name)
+        if name.endswith('.dist-info'):
+            found.append((path, 'METADATA'))
+        elif name.endswith('.egg-info'):
+            found.append((path, 'PKG-INFO'))
+        elif name.endswith('.egg'):
+            found.append((os.path.join(path, 'EGG-INFO'), 'PKG-INFO'))
+        elif name.endswith('.egg-link'):
+            try:
+                with open(path, 'r') as egg_link:
+                    source = egg_link.readline().strip()
+            except OSError:
+                continue
+            found.extend((info, 'PKG-INFO') for info in glob.glob(os.path.join(source, '*.egg-info')))
+    return found
+
+
+@EVENTS.phase('discover_plugins')
+def discover_plugins(venv_path):
+    """Find installed third party plugins from the venv's package metadata, without starting OctoPrint
+
+    Plugins register themselves using the `octoprint.plugin` entry point, with the plugin key as the name.
+    Plugins OctoPrint considers bundled are left out, the same as in a backup, as OctoPrint installs them itself.
+
+    Returns:
+        list: plugins in the same format as a backup's plugin list, or None if the venv's site-packages could not be found
+    """
+    site_packages_dirs = find_site_packages(venv_path)
+    if not site_packages_dirs:
+        return None
+
+    plugin_list = []
+    keys = set()
+    for site_packages in site_packages_dirs:
+        for metadata_dir, metadata_file in find_distribution_metadata(site_packages):
+            name = read_metadata_field(os.path.join(metadata_dir, metadata_file), 'Name')
+            if name and name.lower() == 'octoprint':
+                continue
+            for key in read_plugin_entry_points(os.path.join(metadata_dir, 'entry_points.txt')):
+                if key not in keys and key not in BUNDLED_PLUGINS:
+                    keys.add(key)
+                    plugin_list.append({'key': key, 'name': name or key})
+
+    return sorted(plugin_list, key=lambda plugin: plugin['name'].lower())
+
+
+@EVENTS.phase('stop_octoprint')
 def stop_octoprint(command, backup_path):
     output, poll = run_sys_command(command.split())
     if poll != 0:
@@ -526,7 +2308,8 @@ def stop_octoprint(command, backup_path):
         bail("Fatal Error: Exiting")
 
 
-def create_new_venv(venv_path, backup_path):
+@EVENTS.phase('create_new_venv')
+def create_new_venv(venv_path, backup_path, wheelhouse=None, move_existing=True, prompt=None):
     def failed(backup_path, msg):
         print_c("ERROR: Failed to create Python 3 venv", TextColors.RED)
         print_c(msg, TextColors.RED)
@@ -534,10 +2317,12 @@ def create_new_venv(venv_path, backup_path):
         bail("Fatal Error: Exiting")
 
     print("Creating new Python 3 environment...")
-    output, poll = run_sys_command(['mv', venv_path, '{}.bak'.format(venv_path)])
-    if poll != 0:
-        failed(backup_path, "Could not move existing env out of the way\nPlease check you don't have anything at {}.bak".format(venv_path))
-    output, poll = run_sys_command(['python3', '-m', 'venv', venv_path])
+    if move_existing:
+        output, poll = run_sys_command(['mv', venv_path, '{}.bak'.format(venv_path)])
+        if poll != 0:
+            failed(backup_path, "Could not move existing env out of the way\nPlease check you don't have anything at {}.bak".format(venv_path))
+        JOURNAL.update(old_venv_moved=True)
+    output, poll = run_sys_command(['python3', '-m', 'venv'] + (['--prompt', prompt] if prompt else []) + [venv_path])
     if poll != 0:
         failed(backup_path, "Could not create new venv")
 
@@ -545,90 +2330,515 @@ def create_new_venv(venv_path, backup_path):
 
     # Install wheel into the venv for faster installs & no errors
     print("Installing build dependencies...")
-    output, poll = run_sys_command(["{}/bin/pip".format(venv_path), "install", "wheel"])
+    output, poll = pip_install(venv_path, ["wheel"], wheelhouse)
     if poll != 0:
         print_c("Failed to install wheel in the venv, continuing without it")
         print_c("You may have slow install times or see some errors, but it will still work.")
 
     # OctoPi 0.17/Python 3.7.3 ships with pip 18.x, which is too old.
     print("Updating pip...")
-    output, poll = run_sys_command(["{}/bin/pip".format(venv_path), "install", "--upgrade", "pip"])
+    output, poll = pip_install(venv_path, ["--upgrade", "pip"], wheelhouse)
     if poll != 0:
         print_c("Failed to update pip. Upgrade to Python 3 will succeed, but direct updates in OctoPrint")
         print_c("may not be supported if the existing pip version is outdated.")
 
 
-def install_octoprint(venv_path, backup_path):
+@EVENTS.phase('install_octoprint')
+def install_octoprint(venv_path, backup_path, wheelhouse=None, staged=False):
     print("\nInstalling OctoPrint... ", end="")
     print_c("(This may take a while - Do not cancel!)", TextColors.YELLOW)
-    output, poll = run_sys_command(['{}/bin/python'.format(venv_path), '-m', 'pip', 'install', 'OctoPrint'], custom_parser=pip_output_parser)
+    output, poll = pip_install(venv_path, ['OctoPrint'], wheelhouse, custom_parser=pip_output_parser)
 
     if poll != 0:
         print_c("ERROR: OctoPrint failed to install", TextColors.RED)
-        print("To restore your previous install, download the file at: ")
-        print("https://raw.githubusercontent.com/cp2004/Octoprint-Upgrade-To-Py3/master/go_back.py")
+        if staged:
+            print("Your existing install has not been touched")
+            shutil.rmtree(venv_path, ignore_errors=True)
+        else:
+            print("To restore your previous install, download the file at: ")
+            print("https://raw.githubusercontent.com/cp2004/Octoprint-Upgrade-To-Py3/master/go_back.py")
         cleanup(backup_path)
         bail("Error installing OctoPrint, cannot proceed")
     else:
         print_c("OctoPrint successfully installed!", TextColors.GREEN)
 
 
-def pip_output_parser(line, last_state):
-    if 'Collecting' in line and last_state != 'collecting':
-        print("Collecting required packages")
-        return 'collecting'
-    if 'Installing' in line and last_state != 'installing':
-        print("Installing collected packages")
-        return 'installing'
-    if 'error' in line.lower():
-        print("Error installing package")
-        print_c(line, TextColors.RED)
-    else:
-        return last_state
+def install_octoprint_setuptools(venv_path, wheelhouse=None):
+    """Install OctoPrint without its dependencies, so plugins can be built before it is installed properly
+
+    Most plugins' setup.py imports octoprint_setuptools, which comes with OctoPrint, and pip builds them with
+    the venv's own packages. setuptools is needed for that too, but is otherwise only one of OctoPrint's dependencies.
+
+    Returns:
+        bool: True if it was installed
+    """
+    output, poll = pip_install(venv_path, ['--no-deps', 'OctoPrint', 'setuptools'], wheelhouse, show_stderr=False)
+    return poll == 0
+
 
+@functools.lru_cache(maxsize=None)
+@EVENTS.phase('fetch_plugin_repo')
+def fetch_plugin_repo():
+    """Download OctoPrint's plugin repository, or use the cached copy if it hasn't changed
 
-def install_plugins(venv_path, plugin_keys, backup_path):
+    The cache is revalidated using the ETag & Last-Modified headers, and the repo is parsed as it
+    is downloaded, so the full plugins.json never has to be held in memory. It is only fetched once
+    per run, however many times it is needed.
+
+    Returns:
+        dict: plugins on the repo by id, or None if it could not be downloaded
+    """
     try:
         import requests
     except ImportError:
-        print_c("Required dependency requests is missing... No plugins can be installed", TextColors.RED)
-        print_c("OctoPrint has been installed, but no plugins have", TextColors.YELLOW)
-        return
+        print_c("Required dependency requests is missing... No plugins can be installed from the plugin repo", TextColors.RED)
+        return None
 
-    print("\nDownloading OctoPrint's plugin repo")
-    response = requests.get('https://plugins.octoprint.org/plugins.json')
-    if not response.ok:
-        print("Plugin repo couldn't be reached")
-        print("Do you want to continue without installing plugins?")
-        confirm_to_go("Press enter to continue")
-        return
+    cache = load_plugin_repo_cache()
+    headers = {}
+    if cache:
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
 
-    plugin_repo = response.json()
-    plugins_to_install = []
-    for plugin in plugin_repo:
-        if plugin['id'] in plugin_keys:
-            plugins_to_install.append({'id': plugin['id'], 'url': plugin['archive'], 'name': plugin['title']})
-            plugin_keys.remove(plugin['id'])
-    print("")
+    print("\nDownloading OctoPrint's plugin repo")
+    try:
+        with requests.get(PLUGIN_REPO_URL, headers=headers, stream=True, timeout=30) as response:
+            if response.status_code == 304 and cache:
+                print("Plugin repo has not changed, using cached copy")
+                return cache['plugins']
+
+            if response.ok:
+                plugins = index_plugin_repo(response.iter_content(chunk_size=64 * 1024))
+                save_plugin_repo_cache({
+                    'url': PLUGIN_REPO_URL,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'plugins': plugins,
+                })
+                return plugins
+    except (requests.exceptions.RequestException, ValueError):
+        pass
+
+    if cache:
+        print_c("Plugin repo couldn't be reached, using the copy cached from a previous run", TextColors.YELLOW)
+        return cache['plugins']
+
+    print("Plugin repo couldn't be reached")
+    print("Do you want to continue without installing plugins?")
+    confirm_to_go("Press enter to continue")
+    return None
+
+
+def index_plugin_repo(chunks):
+    """Parse the plugin repo from chunks of bytes into a dict by plugin id, keeping only PLUGIN_REPO_FIELDS"""
+    plugins = {}
+    for plugin in iter_json_array(chunks):
+        plugins[plugin['id']] = {field: plugin.get(field) for field in PLUGIN_REPO_FIELDS}
+    return plugins
+
+
+def iter_json_array(chunks):
+    """Yield each item of a JSON array of objects, as soon as enough chunks of it have been read"""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    started = False
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Incomplete item, wait for the next chunk
+                break
+            yield item
+        buffer = buffer[pos:]
 
-    plugin_errors = []
-    for plugin in plugins_to_install:
-        print("Installing {}".format(plugin['name']))
-        output, poll = run_sys_command(['{}/bin/python'.format(venv_path), '-m', 'pip', 'install', plugin['url']], custom_parser=pip_output_parser)
-        if poll != 0:
-            print_c("ERROR: Plugin {} failed to install".format(plugin['name']), TextColors.RED)
-            plugin_errors.append(plugin)
+    raise ValueError("Unexpected end of JSON array")
+
+
+def load_plugin_repo_cache():
+    try:
+        with open(PLUGIN_REPO_CACHE, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    if cache.get('url') != PLUGIN_REPO_URL or not isinstance(cache.get('plugins'), dict):
+        return None
+    return cache
+
+
+def save_plugin_repo_cache(cache):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first, so an interrupted write never leaves a corrupt cache
+        temp_path = PLUGIN_REPO_CACHE + '.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(temp_path, PLUGIN_REPO_CACHE)
+    except OSError:
+        print_c("Warning: Could not save the plugin repo cache", TextColors.YELLOW)
+
+
+def match_plugins(plugin_repo, plugin_keys):
+    """Find the plugins to install on the plugin repo, removing the keys found from plugin_keys"""
+    plugins_to_install = []
+    for key in list(plugin_keys):
+        plugin = plugin_repo.get(key)
+        if plugin:
+            plugins_to_install.append({'id': plugin['id'], 'url': plugin['archive'], 'name': plugin['title'],
+                                       'compatibility': plugin.get('compatibility') or {}})
+            plugin_keys.remove(key)
+    return plugins_to_install
+
+
+def compare_releases(a, b):
+    """Compare two release tuples, such as (1, 4) & (1, 4, 2), padding the shorter one with zeros. Returns <0, 0 or >0 like cmp()"""
+    length = max(len(a), len(b))
+    a, b = a + (0,) * (length - len(a)), b + (0,) * (length - len(b))
+    return (a > b) - (a < b)
+
+
+def parse_release(version):
+    """Read the release numbers from the start of a version, eg. '1.5.0rc1' -> (1, 5, 0)
+
+    Returns:
+        tuple: release numbers, or None if the version doesn't start with a number
+    """
+    match = re.match(r"\s*v?(\d+(?:\.\d+)*)", version)
+    return tuple(int(part) for part in match.group(1).split('.')) if match else None
+
+
+def version_matches(version, specifiers):
+    """Check a version against comma separated PEP 440 specifiers, such as '>=2.7,<4' or '==1.4.*'
+
+    Only release numbers are compared, pre-releases count as the release they lead up to. A version
+    with no operator means that version or later, the same as OctoPrint's plugin manager. Anything
+    that can't be understood is ignored, so it never stops a plugin being installed.
+    """
+    release = parse_release(version)
+    if release is None:
+        return True
+    for specifier in specifiers.split(','):
+        match = re.match(r"\s*(~=|===|==|!=|<=|>=|<|>)?\s*(\S+?)(\.\*)?\s*$", specifier)
+        wanted = parse_release(match.group(2)) if match else None
+        if wanted is None:
+            continue
+        operator = (match.group(1) or '>=').replace('===', '==')
+        result = compare_releases(release, wanted)
+        if match.group(3) or operator == '~=':
+            # ==1.4.* is any 1.4 release, ~=1.4.2 is any 1.4 release from 1.4.2
+            prefix = wanted if match.group(3) else wanted[:-1]
+            same = compare_releases(release[:len(prefix)], prefix) == 0
+            matches = {'==': same, '!=': not same, '~=': same and result >= 0}.get(operator, True)
+        else:
+            matches = {
+                '==': result == 0,
+                '!=': result != 0,
+                '<': result < 0,
+                '<=': result <= 0,
+                '>': result > 0,
+                '>=': result >= 0,
+            }[operator]
+        if not matches:
+            return False
+    return True
+
+
+def check_plugin_compatibility(plugin, octoprint_version=None):
+    """Check the compatibility the plugin repo lists for a plugin against the new install
+
+    Plugins that don't list something are assumed to work with it.
+
+    Args:
+        plugin (dict): plugin from match_plugins
+        octoprint_version (str): OctoPrint version installed, or None to not check it
+
+    Returns:
+        str: the reason the plugin is incompatible, or None if it is compatible
+    """
+    compatibility = plugin.get('compatibility') or {}
+
+    # The new venv is created by python3, the same as this script is run with
+    python = compatibility.get('python')
+    if python and not version_matches('.'.join(map(str, sys.version_info[:3])), python):
+        return "needs Python {}".format(python)
+
+    octoprint = compatibility.get('octoprint') or []
+    if isinstance(octoprint, str):
+        octoprint = [octoprint]
+    if octoprint_version and octoprint and not any(version_matches(octoprint_version, entry) for entry in octoprint):
+        return "needs OctoPrint {}".format(" or ".join(octoprint))
+
+    # Entries are OS names, or !name to exclude one
+    systems = [entry.lower() for entry in compatibility.get('os') or []]
+    allowed = [entry for entry in systems if not entry.startswith('!')]
+    if (allowed and 'linux' not in allowed) or '!linux' in systems:
+        return "doesn't support Linux"
+    return None
+
+
+def split_incompatible_plugins(plugins, octoprint_version=None):
+    """Separate the plugins that the plugin repo says won't work on the new install
+
+    Returns:
+        list: compatible plugins
+        list: tuples of (plugin, reason) for the incompatible ones
+    """
+    compatible, incompatible = [], []
+    for plugin in plugins:
+        reason = check_plugin_compatibility(plugin, octoprint_version)
+        if reason:
+            incompatible.append((plugin, reason))
+        else:
+            compatible.append(plugin)
+    return compatible, incompatible
+
+
+def report_incompatible_plugins(incompatible):
+    if len(incompatible):
+        print_c("These plugins are not compatible with the new install, so will not be installed:", TextColors.YELLOW)
+        for plugin, reason in incompatible:
+            print("- {}: {}".format(plugin['name'], reason))
+        print("Check the plugin repo for an alternative, or ask the author for an update")
+
+
+class ArchivePrefetcher:
+    """Downloads plugin archives in the background, so they are on disk by the time OctoPrint has installed
+
+    Plugins are then built from the local files. If a download fails, pip is given the URL as before.
+    Each run downloads to its own directory, so runs at the same time don't remove each other's archives.
+    """
+    ARCHIVE_DIR = os.path.join(CACHE_DIR, 'archives')
+    # pip works out how to unpack an archive from its file name
+    ARCHIVE_EXTENSIONS = ('.whl', '.zip', '.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tar.xz', '.txz', '.tar')
+    ARCHIVE_SIGNATURES = ((b'PK\x03\x04', '.zip'), (b'\x1f\x8b', '.tar.gz'), (b'BZh', '.tar.bz2'), (b'\xfd7zXZ\x00', '.tar.xz'))
+    # Directories of runs that were killed before they could remove them are removed after this many seconds
+    STALE_AGE = 24 * 60 * 60
+
+    def __init__(self, plugins):
+        os.makedirs(self.ARCHIVE_DIR, exist_ok=True)
+        self.remove_stale()
+        self.path = tempfile.mkdtemp(prefix='run-', dir=self.ARCHIVE_DIR)
+        self.stopped = threading.Event()
+        self.futures = {plugin['id']: Future() for plugin in plugins}
+        queue = collections.deque(plugins)
+        # Daemon threads rather than a ThreadPoolExecutor, which Python waits for on exit even if the run bailed
+        for _ in range(max(1, min(8, len(plugins)))):
+            threading.Thread(target=EVENTS.wrap(self.worker), args=(queue,), daemon=True).start()
+
+    @classmethod
+    def start(cls, plugin_keys, wheelhouse=None):
+        """Start downloading the archives of the plugins on the plugin repo that aren't in the wheelhouse
+
+        Returns:
+            ArchivePrefetcher: or None if there is nothing to download
+        """
+        keys = [key for key in plugin_keys if not (wheelhouse and key in wheelhouse.manifest['plugins'])]
+        if not keys or not Checks.requests_installed():
+            return None
+        # OctoPrint isn't installed yet, so only what doesn't depend on its version is checked
+        plugins, incompatible = split_incompatible_plugins(match_plugins(fetch_plugin_repo() or {}, keys))
+        if not plugins:
+            return None
+        print("Downloading {} plugin(s) in the background...".format(len(plugins)))
+        return cls(plugins)
+
+    def worker(self, queue):
+        while not self.stopped.is_set():
+            try:
+                plugin = queue.popleft()
+            except IndexError:
+                return
+            future = self.futures[plugin['id']]
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.download(plugin))
+                except Exception as e:
+                    future.set_exception(e)
+
+    def remove_stale(self):
+        """Remove archives left behind by earlier runs that were killed, or made by older versions of this script"""
+        with contextlib.suppress(OSError), os.scandir(self.ARCHIVE_DIR) as entries:
+            for entry in entries:
+                if entry.stat(follow_symlinks=False).st_mtime < time.time() - self.STALE_AGE:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        with contextlib.suppress(OSError):
+                            os.remove(entry.path)
+
+    def download(self, plugin):
+        import requests
+        import urllib.parse
+        # Archive names are often just master.zip, so each plugin gets its own directory
+        directory = os.path.join(self.path, plugin['id'])
+        part = os.path.join(directory, 'download.part')
+        with EVENTS.phase('download_archive', plugin=plugin['id']):
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with requests.get(plugin['url'], stream=True, timeout=60) as response:
+                    response.raise_for_status()
+                    with open(part, 'wb') as archive:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            if self.stopped.is_set():
+                                raise OSError("Download stopped")
+                            archive.write(chunk)
+                name = os.path.basename(urllib.parse.urlparse(response.url).path)
+                extension = self.archive_extension(name, part)
+                if not extension:
+                    # Left to pip, which can also look at the response's content type
+                    os.remove(part)
+                    return None
+                path = os.path.join(directory, name if name.lower().endswith(extension) else 'archive' + extension)
+                os.replace(part, path)
+            except (requests.exceptions.RequestException, OSError):
+                with contextlib.suppress(OSError):
+                    os.remove(part)
+                return None
+        return path
+
+    def archive_extension(self, name, path):
+        """The extension pip needs to see to unpack the archive, from its name or else the start of the file
+
+        Returns:
+            str: extension, or None if it isn't an archive format that could be recognised
+        """
+        for extension in self.ARCHIVE_EXTENSIONS:
+            if name.lower().endswith(extension):
+                return extension
+        with open(path, 'rb') as archive:
+            start = archive.read(8)
+        for signature, extension in self.ARCHIVE_SIGNATURES:
+            if start.startswith(signature):
+                return extension
+        return None
+
+    def stop(self):
+        """Cancel downloads that haven't started, stop the ones in progress at their next chunk & remove the archives"""
+        self.stopped.set()
+        for future in self.futures.values():
+            future.cancel()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def get(self, plugin):
+        """Wait for a plugin's archive to download
+
+        Returns:
+            str: path to the archive, or None if it wasn't prefetched or the download failed
+        """
+        future = self.futures.get(plugin['id'])
+        return future.result() if future and not future.cancelled() else None
+
+
+@EVENTS.phase('install_plugins')
+def install_plugins(venv_path, plugin_keys, backup_path, wheelhouse=None):
+    wheel_dir = tempfile.mkdtemp(prefix="octoprint-upgrade-wheels-")
+    try:
+        wheels, plugin_errors = collect_plugin_wheels(venv_path, plugin_keys, wheel_dir, wheelhouse)
+        if wheels is None:
+            print_c("OctoPrint has been installed, but no plugins have", TextColors.YELLOW)
+            return
+        plugin_errors.extend(install_plugin_wheels(venv_path, wheels, wheelhouse))
+    finally:
+        shutil.rmtree(wheel_dir, ignore_errors=True)
+
+    report_plugin_errors(plugin_errors, plugin_keys)
+
+
+@EVENTS.phase('install_octoprint_and_plugins')
+def install_octoprint_and_plugins(venv_path, plugin_keys, backup_path, wheelhouse=None, staged=False):
+    """Install OctoPrint & all the plugins with a single pip run, so dependencies are only resolved once
+
+    Plugin wheels are built first, with just OctoPrint itself installed for them to build against. If the
+    combined install fails, OctoPrint is installed on its own and the plugins that are the problem are found
+    with install_plugin_wheels.
+    """
+    wheel_dir = tempfile.mkdtemp(prefix="octoprint-upgrade-wheels-")
+    try:
+        if plugin_keys and not install_octoprint_setuptools(venv_path, wheelhouse):
+            print_c("Warning: Could not install OctoPrint to build plugins with, plugins that need it will fail to build",
+                    TextColors.YELLOW)
+        wheels, plugin_errors = collect_plugin_wheels(venv_path, plugin_keys, wheel_dir, wheelhouse)
+
+        print("\nInstalling OctoPrint{}... ".format(" & {} plugin(s)".format(len(wheels)) if wheels else ""), end="")
+        print_c("(This may take a while - Do not cancel!)", TextColors.YELLOW)
+        output, poll = pip_install(venv_path, ['OctoPrint'] + [wheel for plugin, wheel in wheels or []], wheelhouse,
+                                   custom_parser=pip_output_parser)
+        if poll == 0:
+            print_c("OctoPrint successfully installed!", TextColors.GREEN)
+            for plugin, wheel in wheels or []:
+                plugin_installed(plugin)
         else:
-            print_c("Plugin {} successfully installed".format(plugin['name']), TextColors.GREEN)
-            if plugin['id'] == 'bedlevelvisualizer':
-                print_c("Warning: You have installed Bed Level visualiser. There is a known issue with it failing silently on Python 3", TextColors.YELLOW)
-                print_c("See more here: https://github.com/jneilliii/OctoPrint-BedLevelVisualizer#known-issues", TextColors.YELLOW)
+            print_c("Failed to install OctoPrint & plugins together, installing OctoPrint first", TextColors.YELLOW)
+            install_octoprint(venv_path, backup_path, wheelhouse, staged)
+            plugin_errors.extend(install_plugin_wheels(venv_path, wheels or [], wheelhouse))
+    finally:
+        shutil.rmtree(wheel_dir, ignore_errors=True)
+
+    if wheels is None:
+        print_c("OctoPrint has been installed, but no plugins have", TextColors.YELLOW)
+        return
+    report_plugin_errors(plugin_errors, plugin_keys)
+
+
+def collect_plugin_wheels(venv_path, plugin_keys, wheel_dir, wheelhouse=None):
+    """Take plugin wheels from the wheelhouse & build the rest from the plugin repo
+
+    Keys of plugins found are removed from plugin_keys.
+
+    Returns:
+        list: tuples of (plugin, path to wheel), or None if the plugin repo couldn't be reached & there's nothing to install
+        list: plugins that failed to build
+    """
+    wheels = []
+    if wheelhouse:
+        wheels = wheelhouse.take_plugins(plugin_keys)
+        print("\nFound {} plugin(s) in the wheelhouse".format(len(wheels)))
+
+    plugins_to_install = []
+    if plugin_keys:
+        plugin_repo = fetch_plugin_repo()
+        if plugin_repo is None and not wheels:
+            return None, []
+        plugins_to_install, incompatible = split_incompatible_plugins(match_plugins(plugin_repo or {}, plugin_keys),
+                                                                      read_octoprint_version(venv_path))
+        report_incompatible_plugins(incompatible)
+    print("")
+
+    if PREFETCH:
+        for plugin in plugins_to_install:
+            plugin['local_archive'] = PREFETCH.get(plugin)
+
+    build_errors = []
+    if plugins_to_install:
+        built, build_errors = build_plugin_wheels(venv_path, plugins_to_install, wheel_dir, args.jobs)
+        wheels.extend(built)
+    return wheels, build_errors
+
 
+def report_plugin_errors(plugin_errors, plugin_keys):
     if len(plugin_errors):
         print_c("Failed to install these plugins:", TextColors.YELLOW)
         for plugin in plugin_errors:
             print("- {}, url: {}".format(plugin['name'], plugin['url']))
-        print_c("They were found on the plugin repo but failed to install", TextColors.YELLOW)
+        print_c("They were found on the plugin repo but failed to build or install", TextColors.YELLOW)
 
     if len(plugin_keys):
         print_c("These plugins were not found on the repo", TextColors.YELLOW)
@@ -637,6 +2847,471 @@ def install_plugins(venv_path, plugin_keys, backup_path):
             print("- {}".format(not_found_plugin))
 
 
+def build_plugin_wheel(venv_path, plugin, wheel_dir):
+    """Build a single plugin archive into a wheel
+
+    Each plugin gets its own directory, so the resulting wheel can be matched back to the plugin.
+
+    Returns:
+        str: path to the built wheel, or None if the build failed
+    """
+    plugin_dir = os.path.join(wheel_dir, plugin['id'])
+    with BUILD_SLOTS, EVENTS.phase('build_plugin_wheel', plugin=plugin['id']):
+        output, poll = run_sys_command(['{}/bin/python'.format(venv_path), '-m', 'pip', 'wheel', '--no-deps',
+                                        '--wheel-dir', plugin_dir, plugin.get('local_archive') or plugin['url']])
+    if poll != 0:
+        return None
+
+    for filename in os.listdir(plugin_dir):
+        if filename.endswith('.whl'):
+            return os.path.join(plugin_dir, filename)
+    return None
+
+
+@EVENTS.phase('build_plugin_wheels')
+def build_plugin_wheels(venv_path, plugins, wheel_dir, jobs):
+    """Build wheels for all the plugins, spread over a pool of workers
+
+    Args:
+        venv_path (str): path to virtual environment
+        plugins (list): plugins to build, as found on the plugin repo
+        wheel_dir (str): directory to put built wheels in
+        jobs (int): number of builds to run at once
+
+    Returns:
+        list: tuples of (plugin, path to wheel) that were built successfully
+        list: plugins that failed to build
+    """
+    if not plugins:
+        return [], []
+
+    jobs = max(1, min(jobs, len(plugins)))
+    print("Building {} plugin(s), {} at a time...".format(len(plugins), jobs))
+
+    wheels = []
+    build_errors = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(EVENTS.wrap(build_plugin_wheel), venv_path, plugin, wheel_dir): plugin for plugin in plugins}
+        for future in as_completed(futures):
+            plugin = futures[future]
+            wheel = future.result()
+            if wheel:
+                print("Built {}".format(plugin['name']))
+                wheels.append((plugin, wheel))
+            else:
+                print_c("ERROR: Plugin {} failed to build".format(plugin['name']), TextColors.RED)
+                build_errors.append(plugin)
+
+    # Keep the install order the same as the plugin repo order, rather than the order builds finished
+    wheels.sort(key=lambda item: plugins.index(item[0]))
+    return wheels, build_errors
+
+
+@EVENTS.phase('install_plugin_wheels')
+def install_plugin_wheels(venv_path, wheels, wheelhouse=None):
+    """Install all the built plugin wheels in a single pip run
+
+    If that fails, the plugins that can't be installed are found by bisecting the set with pip's dry run,
+    then the rest are installed together. Each wheel is only installed on its own as a last resort, or
+    if pip is too old to have --dry-run.
+
+    Returns:
+        list: plugins that failed to install
+    """
+    if not wheels:
+        return []
+
+    print("Installing built plugins...")
+    output, poll = pip_install(venv_path, [wheel for plugin, wheel in wheels], wheelhouse, custom_parser=pip_output_parser)
+    if poll == 0:
+        for plugin, wheel in wheels:
+            plugin_installed(plugin)
+        return []
+
+    install_errors = []
+    good = wheels
+    if pip_supports_dry_run(venv_path):
+        print_c("Failed to install all plugins together, finding which ones can't be installed", TextColors.YELLOW)
+        with EVENTS.phase('bisect_plugins', plugins=len(wheels)):
+            # Dry runs are expected to fail, the plugins that can't be installed are reported afterwards
+            good, bad = _bisect([], wheels, lambda candidates: pip_install(
+                venv_path, ['--dry-run'] + [wheel for plugin, wheel in candidates], wheelhouse, show_stderr=False)[1] == 0,
+                known_failing=True)
+        if not good:
+            # Every dry run failing is more likely to be pip itself, so try them all for real
+            good = wheels
+        else:
+            install_errors = [plugin for plugin, wheel in bad]
+            for plugin in install_errors:
+                print_c("ERROR: Plugin {} can't be installed".format(plugin['name']), TextColors.RED)
+
+        if good:
+            output, poll = pip_install(venv_path, [wheel for plugin, wheel in good], wheelhouse, custom_parser=pip_output_parser)
+            if poll == 0:
+                for plugin, wheel in good:
+                    plugin_installed(plugin)
+                return install_errors
+
+    if good:
+        print_c("Failed to install the plugins together, installing them one at a time", TextColors.YELLOW)
+        for plugin, wheel in good:
+            print("Installing {}".format(plugin['name']))
+            output, poll = pip_install(venv_path, [wheel], wheelhouse, custom_parser=pip_output_parser)
+            if poll != 0:
+                print_c("ERROR: Plugin {} failed to install".format(plugin['name']), TextColors.RED)
+                install_errors.append(plugin)
+            else:
+                plugin_installed(plugin)
+
+    return install_errors
+
+
+def _bisect(base, candidates, test, known_failing=False):
+    """Split candidates into the ones that pass test() together with base, and the ones that don't
+
+    Candidates are added to the passing set in halves, so finding a few bad ones among many takes
+    O(bad * log(candidates)) tests rather than one per candidate. A candidate that only fails in
+    combination with others is counted as bad, rather than the ones already accepted.
+
+    known_failing skips testing the whole set first, when the caller has just seen it fail.
+
+    Returns:
+        list: candidates that passed, in their original order
+        list: candidates that failed
+    """
+    if not candidates:
+        return base, []
+    if not known_failing and test(base + candidates):
+        return base + candidates, []
+    if len(candidates) == 1:
+        return base, list(candidates)
+
+    middle = len(candidates) // 2
+    base, bad_left = _bisect(base, candidates[:middle], test)
+    base, bad_right = _bisect(base, candidates[middle:], test)
+    return base, bad_left + bad_right
+
+
+def plugin_installed(plugin):
+    print_c("Plugin {} successfully installed".format(plugin['name']), TextColors.GREEN)
+    JOURNAL.plugin_installed(plugin['id'])
+    if plugin['id'] == 'bedlevelvisualizer':
+        print_c("Warning: You have installed Bed Level visualiser. There is a known issue with it failing silently on Python 3", TextColors.YELLOW)
+        print_c("See more here: https://github.com/jneilliii/OctoPrint-BedLevelVisualizer#known-issues", TextColors.YELLOW)
+
+
+def get_staging_path(venv_path):
+    return '{}.py3-staging'.format(venv_path)
+
+
+def prepare_staging(venv_path, backup_path):
+    """Make sure the staged environment can be swapped in later, before spending time building it
+
+    Returns:
+        str: path to build the staged environment at
+    """
+    if os.path.exists('{}.bak'.format(venv_path)):
+        print_c("ERROR: There is already something at {}.bak".format(venv_path), TextColors.RED)
+        print_c("Please move or remove it, so the old environment can be moved there")
+        cleanup(backup_path)
+        bail("Fatal Error: Exiting")
+
+    staging_path = get_staging_path(venv_path)
+    if os.path.exists(staging_path):
+        # Left over from a previous attempt that didn't finish
+        print("Removing old staging environment at {}".format(staging_path))
+        shutil.rmtree(staging_path)
+    return staging_path
+
+
+def relocate_venv(staging_path, venv_path):
+    """Point scripts in the staged environment at the path it will end up at
+
+    Console scripts & the activate scripts have the absolute path of the venv written into them when they
+    are created, so the staging path needs replacing before the environment is moved.
+    """
+    # venv & pip always write absolute paths, even when given a relative one
+    old = os.path.abspath(staging_path).encode('utf-8')
+    new = os.path.abspath(venv_path).encode('utf-8')
+    paths = [os.path.join(staging_path, 'pyvenv.cfg')]
+    bin_dir = os.path.join(staging_path, 'bin')
+    paths.extend(os.path.join(bin_dir, name) for name in os.listdir(bin_dir))
+
+    for path in paths:
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            contents = f.read()
+        if old in contents:
+            with open(path, 'wb') as f:
+                f.write(contents.replace(old, new))
+
+
+@EVENTS.phase('swap_venv')
+def swap_venv(staging_path, venv_path):
+    """Move the old environment to venv.bak & the staged environment into its place
+
+    Both are renames on the same filesystem, so the swap takes no time. If the second fails, the old
+    environment is put back.
+
+    Returns:
+        bool: True if the swap succeeded
+    """
+    backup_venv_path = '{}.bak'.format(venv_path)
+    try:
+        os.rename(venv_path, backup_venv_path)
+    except OSError as e:
+        print_c("ERROR: Could not move existing env out of the way: {}".format(e), TextColors.RED)
+        return False
+
+    try:
+        os.rename(staging_path, venv_path)
+    except OSError as e:
+        print_c("ERROR: Could not move new env into place: {}".format(e), TextColors.RED)
+        os.rename(backup_venv_path, venv_path)
+        return False
+
+    print_c("Swapped in the Python 3 environment at {}".format(venv_path), TextColors.GREEN)
+    return True
+
+
+def get_versions_dir(venv_path):
+    return '{}.versions'.format(venv_path)
+
+
+def get_switch_link(venv_path):
+    return '{}.switching'.format(venv_path)
+
+
+def new_version_path(venv_path):
+    """Path for a new environment in the versions directory, named so they sort oldest first"""
+    name = '{}-py{}.{}'.format(time.strftime('%Y%m%d-%H%M%S'), *sys.version_info[:2])
+    return os.path.join(get_versions_dir(venv_path), name)
+
+
+def recover_versioned_venv(venv_path):
+    """Finish a switch that was interrupted after the old environment was moved, but before the symlink replaced it"""
+    switch_link = get_switch_link(venv_path)
+    if not os.path.lexists(venv_path) and os.path.islink(switch_link):
+        print_c("Finishing an interrupted switch of {}".format(venv_path), TextColors.YELLOW)
+        os.replace(switch_link, venv_path)
+
+
+@EVENTS.phase('switch_version')
+def switch_version(venv_path, version_path):
+    """Point the venv path at version_path, by atomically replacing the symlink
+
+    The first time, the existing venv directory is moved into the versions directory as the oldest version.
+    The symlink is relative, so the whole install can still be moved somewhere else.
+
+    Returns:
+        bool: True if the venv path now points at version_path
+    """
+    switch_link = get_switch_link(venv_path)
+    try:
+        if os.path.lexists(switch_link):
+            os.remove(switch_link)
+        os.symlink(os.path.relpath(version_path, os.path.dirname(os.path.abspath(venv_path))), switch_link)
+
+        if not os.path.islink(venv_path):
+            site_packages = find_site_packages(venv_path)
+            python = os.path.basename(os.path.dirname(site_packages[0]))[len('python'):] if site_packages else '2'
+            old_version_path = os.path.join(get_versions_dir(venv_path), '{}-py{}'.format(
+                time.strftime('%Y%m%d-%H%M%S', time.localtime(os.stat(venv_path).st_mtime)), python))
+            os.rename(venv_path, old_version_path)
+            print("Moved the existing environment to {}".format(old_version_path))
+
+        os.replace(switch_link, venv_path)
+    except OSError as e:
+        print_c("ERROR: Could not switch {} to the new environment: {}".format(venv_path, e), TextColors.RED)
+        recover_versioned_venv(venv_path)
+        return False
+
+    print_c("Switched {} to {}".format(venv_path, version_path), TextColors.GREEN)
+    return True
+
+
+def list_versions(venv_path):
+    """Complete environments in the versions directory, oldest first"""
+    versions_dir = get_versions_dir(venv_path)
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted(name for name in os.listdir(versions_dir) if os.path.isfile(os.path.join(versions_dir, name, 'bin', 'python')))
+
+
+@EVENTS.phase('prune_versions')
+def prune_versions(venv_path, keep):
+    """Remove all but the current environment and the `keep` newest others from the versions directory"""
+    versions_dir = get_versions_dir(venv_path)
+    current = os.path.basename(os.path.realpath(venv_path))
+    others = [name for name in os.listdir(versions_dir) if name != current]
+    # Anything without a python is left over from a failed attempt, so it goes first
+    others.sort(key=lambda name: (os.path.isfile(os.path.join(versions_dir, name, 'bin', 'python')), name))
+    for name in others[:max(0, len(others) - keep)]:
+        print("Removing old environment {}".format(name))
+        shutil.rmtree(os.path.join(versions_dir, name), ignore_errors=True)
+
+
+def find_missing_apt_packages(backup_path=None):
+    """Returns: list of the apt packages needed for the new environment that aren't installed"""
+    # backup_path is passed so that it can be cleaned up in the event of an error
+    return [package for package in ('python3-dev', 'python3-venv') if not check_installed_package(package, backup_path)]
+
+
+@EVENTS.phase('install_apt_dependencies')
+def install_apt_dependencies(backup_path=None, missing=None):
+    """Install python3-dev & python3-venv if needed
+
+    The package list is only updated if something needs installing, and is out of date.
+
+    Args:
+        backup_path (str): backup to clean up in the event of an error
+        missing (list): packages the pre-flight probes found missing. If not given, they are checked here
+    """
+    if missing is None:
+        missing = find_missing_apt_packages(backup_path)
+    if not missing:
+        return
+
+    # Update package list - if this isn't done, it can cause errors installing the packages.
+    refresh_package_list(backup_path)
+    run_apt_install(missing, backup_path)
+
+
+def install_software(venv_path, plugin_keys, backup_path, wheelhouse=None, staged=False):
+    """Install OctoPrint & the plugins into a new venv, in one pip run with --single-pass or one after the other"""
+    if args.single_pass:
+        install_octoprint_and_plugins(venv_path, plugin_keys, backup_path, wheelhouse, staged)
+        return
+
+    install_octoprint(venv_path, backup_path, wheelhouse, staged)
+    if len(plugin_keys):
+        install_plugins(venv_path, plugin_keys, backup_path, wheelhouse)
+
+
+@EVENTS.phase('precompile_venv')
+def precompile_venv(venv_path):
+    """Compile all the Python files in the venv's site-packages to bytecode, with a process per CPU core
+
+    Otherwise OctoPrint compiles everything it imports on its first start, which on a Pi makes it much slower
+    to come up. Files that don't compile (for example leftover Python 2 code in some packages) are skipped,
+    Python will just not cache them.
+    """
+    site_packages = glob.glob('{}/lib/python3*/site-packages'.format(venv_path))
+    if not site_packages:
+        return
+
+    print("Precompiling Python files...")
+    start = time.monotonic()
+    output, poll = run_sys_command(['{}/bin/python'.format(venv_path), '-m', 'compileall', '-q', '-j', '0'] + site_packages,
+                                   show_stderr=False)
+    if poll != 0:
+        print_c("Some files could not be precompiled, see {} for details".format(args.command_log), TextColors.YELLOW)
+    print_c("Precompiled Python files in {:.1f}s".format(time.monotonic() - start), TextColors.GREEN)
+
+
+def install_environment(path_to_venv, commands, plugin_keys, backup_location, wheelhouse=None, config_dir=None):
+    """Replace the venv with a new Python 3 one with OctoPrint & the plugins installed, stopping & starting OctoPrint around it
+
+    Returns:
+        bool: False if OctoPrint was started but didn't answer within --ready-timeout
+    """
+    precompile = not args.no_precompile and not args.defer_precompile
+    if args.versioned:
+        # Each environment gets its own directory & the venv path becomes a symlink to the current one, so
+        # OctoPrint keeps running from the old environment until the symlink is switched
+        recover_versioned_venv(path_to_venv)
+        version_path = new_version_path(path_to_venv)
+        os.makedirs(get_versions_dir(path_to_venv), exist_ok=True)
+        create_new_venv(version_path, backup_location, wheelhouse, move_existing=False, prompt=os.path.basename(path_to_venv))
+        install_software(version_path, plugin_keys, backup_location, wheelhouse, staged=True)
+        if precompile:
+            precompile_venv(version_path)
+
+        if commands['stop']:
+            stop_octoprint(commands['stop'], backup_location)
+        if not switch_version(path_to_venv, version_path):
+            print_c("Your existing install has been left in place, the new environment is at {}".format(version_path))
+            if commands['start']:
+                start_octoprint(commands['start'])
+            cleanup(backup_location)
+            bail("Fatal Error: Exiting")
+        # The previous environment is needed to roll back to
+        prune_versions(path_to_venv, max(args.keep, 1) if args.rollback_on_failure else args.keep)
+    elif args.blue_green:
+        # Build the new environment while OctoPrint is still running, then stop it just for the swap
+        staging_path = prepare_staging(path_to_venv, backup_location)
+        create_new_venv(staging_path, backup_location, wheelhouse, move_existing=False, prompt=os.path.basename(path_to_venv))
+        install_software(staging_path, plugin_keys, backup_location, wheelhouse, staged=True)
+        if precompile:
+            precompile_venv(staging_path)
+        relocate_venv(staging_path, path_to_venv)
+
+        if commands['stop']:
+            stop_octoprint(commands['stop'], backup_location)
+        if not swap_venv(staging_path, path_to_venv):
+            print_c("Your existing install has been left in place, the new environment is at {}".format(staging_path))
+            if commands['start']:
+                start_octoprint(commands['start'])
+            cleanup(backup_location)
+            bail("Fatal Error: Exiting")
+    else:
+        # Only this layout changes the existing install in place, so it is the one that needs picking up part way through
+        if commands['stop']:
+            JOURNAL.step('stop_octoprint', stop_octoprint, commands['stop'], backup_location)
+        JOURNAL.step('create_new_venv', resume_new_venv, path_to_venv, backup_location, wheelhouse,
+                     valid=lambda: os.path.isfile('{}/bin/python'.format(path_to_venv)))
+        if args.single_pass:
+            JOURNAL.step('install_software', install_octoprint_and_plugins, path_to_venv, remaining_plugins(plugin_keys),
+                         backup_location, wheelhouse, valid=lambda: octoprint_installed(path_to_venv))
+        else:
+            JOURNAL.step('install_octoprint', install_octoprint, path_to_venv, backup_location, wheelhouse,
+                         valid=lambda: octoprint_installed(path_to_venv))
+            plugin_keys = remaining_plugins(plugin_keys)
+            if len(plugin_keys):
+                JOURNAL.step('install_plugins', install_plugins, path_to_venv, plugin_keys, backup_location, wheelhouse)
+        if precompile:
+            precompile_venv(path_to_venv)
+    ready = True
+    if commands['start']:
+        started = time.monotonic()
+        start_octoprint(commands['start'])
+        if config_dir and args.ready_timeout > 0:
+            ready = wait_for_octoprint(config_dir, started + args.ready_timeout, started) is not None
+            if not ready and args.rollback_on_failure:
+                if roll_back(path_to_venv, commands):
+                    if JOURNAL.state:
+                        JOURNAL.clear()
+                    wait_for_octoprint(config_dir, time.monotonic() + args.ready_timeout)
+                cleanup(backup_location)
+                bail("Fatal Error: OctoPrint didn't start in the new environment")
+    if args.defer_precompile and not args.no_precompile:
+        precompile_venv(path_to_venv)
+    return ready
+
+
+def resume_new_venv(venv_path, backup_path, wheelhouse=None):
+    """Create the new venv, or replace the partly built one if an interrupted run already moved the old one to venv.bak"""
+    if JOURNAL.state and JOURNAL.state.get('old_venv_moved') and os.path.isdir('{}.bak'.format(venv_path)):
+        if os.path.exists(venv_path):
+            print("Removing the partly built environment at {}".format(venv_path))
+            shutil.rmtree(venv_path)
+        create_new_venv(venv_path, backup_path, wheelhouse, move_existing=False)
+    else:
+        create_new_venv(venv_path, backup_path, wheelhouse)
+
+
+def remaining_plugins(plugin_keys):
+    """Plugin keys that the interrupted run didn't install yet"""
+    installed = JOURNAL.state['installed_plugins'] if JOURNAL.state else []
+    return [key for key in plugin_keys if key not in installed]
+
+
+def octoprint_installed(venv_path):
+    return read_octoprint_version(venv_path) is not None
+
+
+@EVENTS.phase('start_octoprint')
 def start_octoprint(command):
     output, poll = run_sys_command(command.split())
     if poll != 0:
@@ -644,62 +3319,457 @@ def start_octoprint(command):
         print("You will need to start it yourself")
 
 
-def end_text(venv_path):
-    print_c("Finished! OctoPrint should be ready to go", TextColors.GREEN)
-    print("Once you have verified the install works, you can safely remove the folder {}.bak".format(venv_path))
+def read_server_address(config_dir):
+    """Read the host & port OctoPrint's server listens on from config.yaml
+
+    Only the two values are needed, so they are picked out line by line rather than needing PyYAML.
+
+    Returns:
+        tuple: host & port to connect to, defaulting to OctoPrint's own defaults
+    """
+    host, port = None, 5000
+    try:
+        with open(os.path.join(config_dir, 'config.yaml'), 'r') as config:
+            in_server = False
+            indent = None
+            for line in config:
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+                line_indent = len(line) - len(line.lstrip())
+                if line_indent == 0:
+                    in_server = line.split('#')[0].strip() == 'server:'
+                    indent = None
+                    continue
+                if not in_server:
+                    continue
+                # Only the keys directly in server, not ones nested deeper
+                indent = indent if indent is not None else line_indent
+                match = re.match(r"(host|port):\s*(.*?)\s*(?:#.*)?$", line.strip())
+                if line_indent == indent and match:
+                    value = match.group(2).strip('\'"')
+                    if match.group(1) == 'host':
+                        host = value
+                    elif value.isdigit():
+                        port = int(value)
+    except OSError:
+        pass
+
+    # Listening on all addresses, so connect locally
+    if host in (None, '', '0.0.0.0'):
+        host = '127.0.0.1'
+    elif host == '::':
+        host = '::1'
+    return host, port
+
+
+@EVENTS.phase('wait_for_octoprint')
+def wait_for_octoprint(config_dir, deadline, started=None):
+    """Poll OctoPrint's API until it answers, or the deadline (from time.monotonic()) passes
+
+    Args:
+        config_dir (str): OctoPrint's basedir, to read the server address from
+        deadline (float): time.monotonic() to give up at
+        started (float): time.monotonic() OctoPrint was started at, to report how long it took
+
+    Returns:
+        float: seconds OctoPrint took to start, or None if it didn't answer in time
+    """
+    import urllib.request
+    import urllib.error
+
+    host, port = read_server_address(config_dir)
+    url = 'http://{}:{}/api/version'.format('[{}]'.format(host) if ':' in host else host, port)
+    started = started or time.monotonic()
+    # A proxy set in the environment can't reach OctoPrint on this machine
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    print("Waiting for OctoPrint to start at {}...".format(url))
+    while True:
+        try:
+            opener.open(url, timeout=5).close()
+            ready = True
+        except urllib.error.HTTPError as e:
+            # Without an API key the request is refused, but the server is up
+            ready = e.code < 500
+        except (OSError, ValueError):
+            ready = False
+
+        if ready:
+            took = time.monotonic() - started
+            EVENTS.emit('octoprint_ready', url=url, duration=took)
+            print_c("OctoPrint is up, it took {:.1f}s to start".format(took), TextColors.GREEN)
+            return took
+        if time.monotonic() >= deadline:
+            print_c("ERROR: OctoPrint didn't answer at {} in time".format(url), TextColors.RED)
+            return None
+        time.sleep(1)
+
+
+@EVENTS.phase('roll_back')
+def roll_back(venv_path, commands):
+    """Put the old environment back, the same way go_back.py does
+
+    Versioned venvs are switched back to the previous version, otherwise the new environment is moved to
+    venvFAIL.bak & the old one back from venv.bak.
+    """
+    print_c("Going back to the old environment...", TextColors.YELLOW)
+    if commands['stop']:
+        run_sys_command(commands['stop'].split())
+
+    if os.path.islink(venv_path):
+        current = os.path.basename(os.path.realpath(venv_path))
+        versions = list_versions(venv_path)
+        index = versions.index(current) if current in versions else len(versions)
+        restored = index > 0 and switch_version(venv_path, os.path.join(get_versions_dir(venv_path), versions[index - 1]))
+    else:
+        failed_path = '{}FAIL.bak'.format(venv_path)
+        try:
+            if os.path.lexists(failed_path):
+                shutil.rmtree(failed_path)
+            os.rename(venv_path, failed_path)
+            os.rename('{}.bak'.format(venv_path), venv_path)
+            restored = True
+        except OSError as e:
+            print_c("ERROR: {}".format(e), TextColors.RED)
+            restored = False
+
+    if restored:
+        print_c("The old environment has been put back", TextColors.GREEN)
+    else:
+        print_c("ERROR: Could not put the old environment back, please use go_back.py", TextColors.RED)
+    if commands['start']:
+        start_octoprint(commands['start'])
+    return restored
+
+
+def end_text(venv_path, ready=True):
+    if ready:
+        print_c("Finished! OctoPrint should be ready to go", TextColors.GREEN)
+    else:
+        print_c("Warning: The upgrade finished, but OctoPrint didn't answer after being started", TextColors.YELLOW)
+        print_c("Check its log (octoprint.log), or use --rollback-on-failure to go back automatically next time", TextColors.YELLOW)
+    if os.path.islink(venv_path):
+        print("Previous environments are kept in {}, and old ones are removed automatically".format(get_versions_dir(venv_path)))
+    else:
+        print("Once you have verified the install works, you can safely remove the folder {}.bak".format(venv_path))
     print("If you want to go back (If it doesn't work) to Python 2 download the file at: ")
     print("https://raw.githubusercontent.com/cp2004/Octoprint-Upgrade-To-Py3/master/go_back.py")
 
 
-if __name__ == '__main__':
-    start_text()
-    if not confirm_to_go():
-        bail("Bye!")
+# ---------------------
+# Upgrading several instances at once, driven by a manifest file
+# ---------------------
+class ThreadOutput:
+    """Stands in for sys.stdout/stderr, sending output from each thread to its own log file if it has been given one"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
 
-    print("Checking system info...")
-    preflight = Checks()
-    preflight.run()
+    def log_to(self, log_file):
+        self.local.log_file = log_file
 
-    is_octopi = preflight.is_octopi()
-    is_octopi_compatible = preflight.is_octopi_compatible()
+    def _target(self):
+        return getattr(self.local, 'log_file', None) or self.stream
 
-    if is_octopi and not is_octopi_compatible:
-        print_c("Looks like your OctoPi install is not compatible with this script")
-        print_c("Please check your other options for upgrading to Python 3.")
-        bail("Fatal Error: OctoPi not compatible, exiting...")
+    def write(self, data):
+        return self._target().write(data)
 
-    path_to_venv, commands, config_dir = get_env_config(is_octopi)
+    def flush(self):
+        self._target().flush()
 
-    print("Checking OctoPrint version...")
-    octoprint_greater_140 = test_octoprint_version(path_to_venv)
-    if not octoprint_greater_140:
-        bail("Please upgrade to an OctoPrint version >= 1.4.0 for Python 3 compatibility")
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
-    # Create backup & read plugin list
-    backup_location = create_backup(path_to_venv, config_dir)
-    plugin_keys = read_plugins_from_backup(backup_location)
 
-    # Update package list - if this isn't done, it can cause errors installing the packages.
-    update_package_list(backup_location)
+class Instance:
+    """One OctoPrint install listed in the manifest"""
+    def __init__(self, config):
+        self.name = config['name']
+        self.venv_path = config['venv']
+        self.config_dir = config['basedir']
+        self.commands = {'stop': config.get('stop', ''), 'start': config.get('start', '')}
+        self.log_path = os.path.join(CACHE_DIR, 'logs', '{}.log'.format(self.name))
+        self.plugin_keys = []
+        self.backup_path = None
+        # Backup made with --backup or --snapshot, which is kept afterwards
+        self.kept_backup = None
+        self.status = "Not started"
+        self.failed = False
 
-    # Check for & install python3-dev if necessary
-    # backup_location is passed to these so that they can clean up in the event of an error
-    if not check_installed_package("python3-dev"):
-        run_apt_install("python3-dev", backup_location)
 
-    # Check for & install python3-venv if necessary
-    if not check_installed_package("python3-venv"):
-        run_apt_install("python3-venv", backup_location)
+def load_manifest(path):
+    """Read the instances to upgrade from a manifest file
 
-    # Install OctoPrint
-    if commands['stop']:
-        stop_octoprint(commands['stop'], backup_location)
-    create_new_venv(path_to_venv, backup_location)
-    install_octoprint(path_to_venv, backup_location)
-    if len(plugin_keys):
-        install_plugins(path_to_venv, plugin_keys, backup_location)
-    if commands['start']:
-        start_octoprint(commands['start'])
+    The manifest is a JSON list of instances, or an object with an `instances` list. Each instance needs
+    `venv` & `basedir` paths, and can have a `name` and `stop` & `start` service commands.
 
-    cleanup(backup_location)
-    end_text(path_to_venv)
+    Returns:
+        list: Instance for each entry in the manifest
+    """
+    try:
+        with open(path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        bail("Error: Could not read manifest {}: {}".format(path, e))
+
+    configs = manifest.get('instances') if isinstance(manifest, dict) else manifest
+    if not isinstance(configs, list) or not configs:
+        bail("Error: No instances found in manifest {}".format(path))
+
+    instances = []
+    for number, config in enumerate(configs, start=1):
+        if not isinstance(config, dict) or not config.get('venv') or not config.get('basedir'):
+            bail("Error: Instance {} in the manifest needs a venv and a basedir".format(number))
+        config['venv'] = config['venv'].rstrip('/')
+        config.setdefault('name', os.path.basename(config['venv']))
+        if config['name'] in [instance.name for instance in instances]:
+            bail("Error: There is more than one instance called {} in the manifest".format(config['name']))
+        instances.append(Instance(config))
+    return instances
+
+
+def run_instance_step(instance, step, *step_args):
+    """Run a step for an instance, with all its output going to the instance's log
+
+    Errors (including bail()) only fail this instance, not the others.
+    """
+    with open(instance.log_path, 'a') as log_file:
+        sys.stdout.log_to(log_file)
+        sys.stderr.log_to(log_file)
+        try:
+            with EVENTS.phase(step.__name__, instance=instance.name):
+                step(instance, *step_args)
+        except SystemExit:
+            instance.failed = True
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            instance.failed = True
+        finally:
+            sys.stdout.log_to(None)
+            sys.stderr.log_to(None)
+    return instance
+
+
+def prepare_instance(instance):
+    print("Checking {} ({})".format(instance.name, instance.venv_path))
+    instance.status = "Failed checking the install"
+    if not os.path.isfile("{}/bin/python".format(instance.venv_path)):
+        bail("Invalid venv path {}".format(instance.venv_path))
+    if not check_venv_python(instance.venv_path):
+        bail("Virtual environment is already Python 3")
+    require_octoprint_140(instance.venv_path)
+
+    instance.status = "Failed reading installed plugins"
+    print("Reading installed plugins...")
+    plugin_list = discover_plugins(instance.venv_path)
+    if plugin_list is None:
+        instance.backup_path = create_backup(instance.venv_path, instance.config_dir)
+        instance.plugin_keys = read_plugins_from_backup(instance.backup_path)
+    else:
+        if args.backup or args.snapshot:
+            instance.kept_backup = make_backup(instance.venv_path, instance.config_dir, plugin_list)
+            print("Backup created at {}".format(instance.kept_backup))
+        instance.plugin_keys = confirm_plugin_list(plugin_list)
+    instance.status = "Ready"
+
+
+def upgrade_instance(instance, wheelhouse):
+    instance.status = "Failed upgrading, check the log"
+    ready = install_environment(instance.venv_path, instance.commands, list(instance.plugin_keys), instance.backup_path,
+                                wheelhouse, instance.config_dir)
+    cleanup(instance.backup_path)
+    if ready:
+        instance.status = "Upgraded"
+    else:
+        instance.status = "Upgraded, but OctoPrint didn't start"
+        instance.failed = True
+    end_text(instance.venv_path, ready)
+    if args.snapshot_zip and args.snapshot and instance.kept_backup:
+        archive_snapshot(instance.kept_backup)
+
+
+def upgrade_instances(manifest_path):
+    """Upgrade all the instances in the manifest at the same time
+
+    Shared work - apt packages, the plugin repo and building OctoPrint & plugin wheels - is done once for all
+    of them. Each instance logs to its own file & one failing doesn't stop the others.
+
+    Returns:
+        int: exit code, non-zero if any instance failed
+    """
+    instances = load_manifest(manifest_path)
+    os.makedirs(os.path.join(CACHE_DIR, 'logs'), exist_ok=True)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = ThreadOutput(stdout)
+    sys.stderr = ThreadOutput(stderr)
+    try:
+        # Output of each instance goes to its log file, so there's no terminal to draw a status line on
+        PROGRESS.enabled = False
+
+        print("Checking {} instance(s)...".format(len(instances)))
+        with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+            list(executor.map(lambda instance: run_instance_step(instance, prepare_instance), instances))
+        ready = [instance for instance in instances if not instance.failed]
+
+        wheelhouse = None
+        if ready:
+            install_apt_dependencies()
+
+            if args.wheelhouse:
+                wheelhouse = Wheelhouse.open(args.wheelhouse)
+                wheelhouse.check_compatible()
+            else:
+                # Every plugin that any instance has is built once, then all the instances install from the same wheels
+                plugin_keys = []
+                for instance in ready:
+                    plugin_keys.extend(key for key in instance.plugin_keys if key not in plugin_keys)
+                build_dir = tempfile.mkdtemp(prefix="octoprint-upgrade-wheelhouse-")
+                populate_wheelhouse(build_dir, plugin_keys)
+                wheelhouse = Wheelhouse(build_dir, temporary=True)
+
+            print("Upgrading {} instance(s)...".format(len(ready)))
+            with ThreadPoolExecutor(max_workers=len(ready)) as executor:
+                futures = [executor.submit(run_instance_step, instance, upgrade_instance, wheelhouse) for instance in ready]
+                for future in as_completed(futures):
+                    instance = future.result()
+                    print_c("{}: {}".format(instance.name, instance.status), TextColors.RED if instance.failed else TextColors.GREEN)
+
+        print("\nSummary")
+        for instance in instances:
+            print_c("- {}: {} (log: {})".format(instance.name, instance.status, instance.log_path),
+                    TextColors.RED if instance.failed else TextColors.GREEN)
+
+        if wheelhouse:
+            wheelhouse.cleanup()
+        EVENTS.summary()
+        return 1 if any(instance.failed for instance in instances) else 0
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def main(argv=None):
+    """Run the upgrade from the command line
+
+    Args:
+        argv (list): command line arguments, sys.argv[1:] if None
+
+    Returns:
+        int: exit code
+    """
+    global FORCE_CONFIRMS, PIP_CONSTRAINTS, PREFETCH
+    configure(parser.parse_args(argv))
+
+    try:
+        if args.event_log:
+            EVENTS.open(args.event_log)
+        PROGRESS.open_log(args.command_log)
+
+        if args.manifest:
+            # Nobody is there to answer prompts for all the instances
+            FORCE_CONFIRMS = True
+            Checks().run()
+            return upgrade_instances(args.manifest)
+
+        if args.build_wheelhouse:
+            if not args.from_backup:
+                bail("Please specify the backup to read plugins from with --from-backup")
+            Checks().run()
+            build_wheelhouse(args.build_wheelhouse, args.from_backup)
+            return 0
+
+        start_text()
+        if not confirm_to_go():
+            bail("Bye!")
+
+        # Nothing here depends on the venv, so it is all checked at once before asking for it
+        print("Checking system info...")
+        preflight = Checks()
+        system = run_probes([
+            Probe('linux', preflight.require_linux),
+            Probe('not_root', preflight.require_not_root),
+            Probe('requests', preflight.requests_installed),
+            Probe('octopi', preflight.require_compatible_octopi, requires=('linux',)),
+            Probe('apt_packages', find_missing_apt_packages, requires=('linux',)),
+        ])
+        if not system['requests']:
+            preflight.confirm_without_requests()
+        is_octopi = system['octopi']
+
+        backup_future = None
+        if args.resume:
+            state = JOURNAL.resume()
+            path_to_venv, commands, config_dir = state['venv'], state['commands'], state['config_dir']
+            plugin_keys, backup_location = list(state['plugin_keys']), state['backup']
+        else:
+            if JOURNAL.load():
+                print_c("An earlier upgrade didn't finish. Use --resume to continue it, rather than starting again", TextColors.YELLOW)
+            path_to_venv, commands, config_dir = get_env_config(is_octopi)
+
+            # Read plugin list straight from the venv, only falling back to reading it from a backup if that doesn't work
+            backup_location = None
+            print("Checking OctoPrint version & reading installed plugins...")
+            venv = run_probes([
+                Probe('octoprint_version', require_octoprint_140, path_to_venv),
+                Probe('plugins', discover_plugins, path_to_venv),
+            ])
+            plugin_list = venv['plugins']
+            if plugin_list is None:
+                print_c("Could not read plugins from the virtual environment, creating a backup to read them from instead", TextColors.YELLOW)
+                backup_location = create_backup(path_to_venv, config_dir)
+                plugin_keys = read_plugins_from_backup(backup_location)
+            else:
+                if args.backup or args.snapshot:
+                    print("Creating a backup of OctoPrint in the background...")
+                    backup_executor = ThreadPoolExecutor(max_workers=1)
+                    backup_future = backup_executor.submit(EVENTS.wrap(make_backup), path_to_venv, config_dir, plugin_list)
+                plugin_keys = confirm_plugin_list(plugin_list)
+
+            JOURNAL.start(path_to_venv, config_dir, commands, plugin_keys, backup_location)
+
+        wheelhouse = None
+        if args.wheelhouse:
+            wheelhouse = Wheelhouse.open(args.wheelhouse)
+            wheelhouse.check_compatible()
+
+        if not args.no_prefetch:
+            PREFETCH = ArchivePrefetcher.start(remaining_plugins(plugin_keys), wheelhouse)
+
+        # If a backup was asked for, it is still being made in the background while this runs
+        JOURNAL.step('install_apt_dependencies', install_apt_dependencies, backup_location, system['apt_packages'])
+
+        if backup_future:
+            # Make sure the backup has finished before changing anything
+            print("Waiting for backup to finish...")
+            kept_backup = backup_future.result()
+            print_c("Backup created at {}".format(kept_backup), TextColors.GREEN)
+
+        if args.resolve_first:
+            if JOURNAL.done('resolve_dependencies') and os.path.isfile(RESOLVED_CONSTRAINTS):
+                PIP_CONSTRAINTS = RESOLVED_CONSTRAINTS
+            else:
+                PIP_CONSTRAINTS = resolve_dependencies(plugin_keys, backup_location, wheelhouse)
+                # Plugins that can't be installed may have been dropped
+                JOURNAL.update(plugin_keys=list(plugin_keys))
+                JOURNAL.complete('resolve_dependencies')
+
+        # Install OctoPrint
+        ready = install_environment(path_to_venv, commands, plugin_keys, backup_location, wheelhouse, config_dir)
+
+        cleanup(backup_location)
+        if wheelhouse:
+            wheelhouse.cleanup()
+        JOURNAL.clear()
+        end_text(path_to_venv, ready)
+        if args.snapshot_zip and args.snapshot and backup_future:
+            # Left until now, so compressing it doesn't keep OctoPrint offline
+            archive_snapshot(kept_backup)
+        EVENTS.summary()
+        return 0 if ready else 1
+    finally:
+        # Ctrl-c or an error mustn't leave the exit waiting for background downloads
+        if PREFETCH:
+            PREFETCH.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())